@@ -1,18 +1,637 @@
+import io
 import os
+import re
+import sys
+import math
 import json
+import time
+import hashlib
+import hmac
+import contextvars
+import itertools
+import sqlite3
+import threading
+import queue
+import random
+import logging
+import secrets
 import requests
 import openai
 import urllib.parse
-from flask import Flask, render_template, request, jsonify, session
+from functools import partial, wraps
+from collections import OrderedDict, defaultdict
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from requests.adapters import HTTPAdapter
+from flask import Flask, Response, g, render_template, request, jsonify, send_file, session, stream_with_context
+from flask.sessions import SessionInterface, SessionMixin
+from werkzeug.datastructures import CallbackDict
 
 # --- Configuration ---
 app = Flask(__name__)
-app.secret_key = os.urandom(24) 
+app.secret_key = os.environ.get("SECRET_KEY") or os.urandom(24)
 
 # --- Reads secret keys from the server environment ---
 GOOGLE_MAPS_API_KEY = os.environ.get("GOOGLE_MAPS_API_KEY")
 OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY")
 openai.api_key = OPENAI_API_KEY
+# Retries go through the upstream scheduler, which needs to see every 429 and 5xx.
+openai.max_retries = 0
+# Overridable so the benchmark stand-ins can take the place of Google (OpenAI reads OPENAI_BASE_URL itself).
+GOOGLE_MAPS_BASE_URL = os.environ.get("GOOGLE_MAPS_BASE_URL", "https://maps.googleapis.com").rstrip("/")
+
+# --- Upstream HTTP ---
+# One pooled keep-alive session for every Google endpoint, plus a bounded pool for fan-out stages.
+# Under gunicorn's gevent worker (see Procfile) sockets, threads and locks are cooperative, so one
+# process holds many conversations' upstream calls in flight; the pools are sized up to match and
+# the upstream scheduler bounds what actually reaches each API.
+def running_under_gevent():
+    try:
+        from gevent import monkey
+    except ImportError:
+        return False
+    return monkey.is_module_patched("socket")
+
+ASYNC_MODE = running_under_gevent()
+if ASYNC_MODE and "trio" not in sys.modules:
+    # The OpenAI client's HTTP stack (httpcore) runs `try: import trio / except ImportError` the first
+    # time a client is built. trio picks its epoll backend on Linux and reads select.epoll while being
+    # imported, but gevent's patched select module has no epoll, so the import fails with
+    # AttributeError, which that guard does not catch. Every completion would then fail. A None entry
+    # in sys.modules makes `import trio` raise ImportError instead. The app only uses the sync client.
+    sys.modules["trio"] = None
+HTTP_TIMEOUT = (float(os.environ.get("HTTP_CONNECT_TIMEOUT", 3.05)), float(os.environ.get("HTTP_READ_TIMEOUT", 10)))
+FETCH_WORKERS = int(os.environ.get("FETCH_WORKERS", 500 if ASYNC_MODE else 10))
+FETCH_STAGE_TIMEOUT = float(os.environ.get("FETCH_STAGE_TIMEOUT", 15))
+
+http = requests.Session()
+http.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=min(FETCH_WORKERS * 2, 200)))
+http.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=min(FETCH_WORKERS * 2, 200)))
+fetch_pool = ThreadPoolExecutor(max_workers=FETCH_WORKERS, thread_name_prefix="upstream")
+# Per-place Details lookups get their own pool: fetch_place_details itself runs on fetch_pool, and
+# children queued behind their blocked parents there would starve until the stage timeout.
+details_pool = ThreadPoolExecutor(max_workers=FETCH_WORKERS, thread_name_prefix="details")
+background_pool = ThreadPoolExecutor(max_workers=int(os.environ.get("BACKGROUND_WORKERS", 50 if ASYNC_MODE else 4)), thread_name_prefix="background",
+                                     initializer=lambda: upstream_priority.set(BACKGROUND))
+
+# --- Metrics ---
+# Process-local counters and histograms, exposed in Prometheus text format at /metrics. Large payload
+# dumps are DEBUG-level only and sampled per request.
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+DEBUG_SAMPLE_RATE = float(os.environ.get("DEBUG_SAMPLE_RATE", 0.01))
+DEBUG_PAYLOAD_MAX_CHARS = 4000
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144)
+
+# Only the app's own logger is configured, so libraries (httpx logs every request at INFO) stay quiet.
+logger = logging.getLogger("locale")
+logger.setLevel(LOG_LEVEL)
+if not logger.handlers:
+    log_handler = logging.StreamHandler()
+    log_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    logger.addHandler(log_handler)
+    logger.propagate = False
+
+class Metrics:
+    def __init__(self):
+        self._counters = defaultdict(float)
+        self._histograms = {}
+        self._gauges = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name, amount=1, **labels):
+        with self._lock: self._counters[(name, tuple(sorted(labels.items())))] += amount
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = {'buckets': buckets, 'counts': [0] * len(buckets), 'sum': 0.0, 'count': 0}
+            for i, bound in enumerate(buckets):
+                if value <= bound: histogram['counts'][i] += 1
+            histogram['sum'] += value
+            histogram['count'] += 1
+
+    def gauge(self, name, callback):
+        """Registers callback() -> [(labels, value)], evaluated whenever metrics are rendered."""
+        self._gauges[name] = callback
+
+    def render(self):
+        def fmt(labels, extra=()):
+            pairs = list(labels) + list(extra)
+            return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}" if pairs else ""
+        lines, typed = [], set()
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted((k, {**v, 'counts': list(v['counts'])}) for k, v in self._histograms.items())
+        for (name, labels), value in counters:
+            if name not in typed: lines.append(f"# TYPE {name} counter"); typed.add(name)
+            lines.append(f"{name}{fmt(labels)} {value:g}")
+        for (name, labels), h in histograms:
+            if name not in typed: lines.append(f"# TYPE {name} histogram"); typed.add(name)
+            for bound, count in zip(h['buckets'], h['counts']):
+                lines.append(f"{name}_bucket{fmt(labels, [('le', bound)])} {count}")
+            lines.append(f"{name}_bucket{fmt(labels, [('le', '+Inf')])} {h['count']}")
+            lines.append(f"{name}_sum{fmt(labels)} {h['sum']:g}")
+            lines.append(f"{name}_count{fmt(labels)} {h['count']}")
+        for name, callback in sorted(self._gauges.items()):
+            lines.append(f"# TYPE {name} gauge")
+            for labels, value in callback():
+                lines.append(f"{name}{fmt(sorted(labels.items()))} {value:g}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+
+def timed_stage(name):
+    """Records the wall time of every call to the decorated function as a pipeline stage.
+
+    Calls made for prefetching (background priority) are left out, so the histogram only describes what users wait on.
+    """
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            if upstream_priority.get() == BACKGROUND: return fn(*args, **kwargs)
+            started = time.monotonic()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                metrics.observe("locale_stage_seconds", time.monotonic() - started, stage=name)
+        return wrapper
+    return decorator
+
+# --- Upstream Scheduler ---
+# Every Google and OpenAI request goes through upstream_call. Each quota (a lane) has a token bucket
+# refilled at its requests-per-second rate and an in-flight limit that halves on a 429/5xx and grows
+# back by one per limit's worth of successes. Waiters are served interactive before background
+# (prefetch, cache refreshes), then in arrival order. A background call that an interactive request is
+# waiting on through SingleFlight is promoted to interactive. Throttled answers are retried with full jitter.
+UPSTREAM_LANES = {"nearby_search": "nearby", "place_details": "details", "distance_matrix": "distance_matrix", "photo": "photo",
+                  "moderation": "chat", "refine": "chat", "ranking": "chat"}
+
+def parse_lane_settings(name, defaults):
+    """defaults overridden by an env var like "chat=10,details=80". Unknown lanes and values <= 0 are rejected."""
+    settings = dict(defaults)
+    for item in os.environ.get(name, "").split(","):
+        if not item.strip(): continue
+        lane, _, value = item.partition("=")
+        lane = lane.strip()
+        if lane not in set(UPSTREAM_LANES.values()):
+            raise ValueError(f"{name}: unknown lane {lane!r}, expected one of {sorted(set(UPSTREAM_LANES.values()))}")
+        try:
+            settings[lane] = float(value)
+        except ValueError:
+            raise ValueError(f"{name}: {item.strip()!r} is not lane=number") from None
+        if settings[lane] <= 0:
+            raise ValueError(f"{name}: {lane} must be greater than 0")
+    return settings
+
+# Set these to the project's quotas. Requests per second, with a burst of UPSTREAM_BURST_SECONDS of it.
+UPSTREAM_RATES = parse_lane_settings("UPSTREAM_RATES", {"nearby": 50, "details": 100, "distance_matrix": 50, "photo": 100, "chat": 25})
+UPSTREAM_CONCURRENCY = parse_lane_settings("UPSTREAM_CONCURRENCY", {"nearby": 50, "details": 100, "distance_matrix": 50, "photo": 50, "chat": 50})
+UPSTREAM_BURST_SECONDS = float(os.environ.get("UPSTREAM_BURST_SECONDS", 1))
+UPSTREAM_WAIT_TIMEOUT = float(os.environ.get("UPSTREAM_WAIT_TIMEOUT", 10))
+UPSTREAM_RETRIES = int(os.environ.get("UPSTREAM_RETRIES", 2))
+UPSTREAM_RETRY_BASE = float(os.environ.get("UPSTREAM_RETRY_BASE", 0.5))
+INTERACTIVE, BACKGROUND = 0, 1
+PRIORITY_NAMES = ("interactive", "background")
+# Pools that only run background work set this in their worker threads.
+upstream_priority = contextvars.ContextVar("upstream_priority", default=INTERACTIVE)
+# Events set by SingleFlight when an interactive caller starts waiting on the call this thread is leading.
+upstream_boosts = contextvars.ContextVar("upstream_boosts", default=())
+
+def effective_priority(ticket):
+    priority, seq, boosts = ticket
+    return (INTERACTIVE if any(b.is_set() for b in boosts) else priority, seq)
+
+class UpstreamBusy(Exception):
+    """A call could not be scheduled within UPSTREAM_WAIT_TIMEOUT."""
+
+class UpstreamLane:
+    def __init__(self, name, rate, max_concurrency):
+        self.name, self.rate, self.max_concurrency = name, rate, max_concurrency
+        self.burst = max(1.0, rate * UPSTREAM_BURST_SECONDS)
+        self.tokens, self.refilled = self.burst, time.monotonic()
+        self.limit, self.in_flight = float(max_concurrency), 0
+        self.waiting = []
+        self._tickets = itertools.count()
+        self._cond = threading.Condition()
+
+    def acquire(self, priority, timeout, boosts=()):
+        """Blocks until this caller is first in line, under the in-flight limit and a token is available.
+        Setting any of boosts moves the caller up to interactive while it waits."""
+        ticket = (priority, next(self._tickets), boosts)
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            self.waiting.append(ticket)
+            try:
+                while True:
+                    now = time.monotonic()
+                    self.tokens = min(self.burst, self.tokens + (now - self.refilled) * self.rate)
+                    self.refilled = now
+                    if min(self.waiting, key=effective_priority) is ticket and self.in_flight < int(self.limit) and self.tokens >= 1:
+                        self.tokens -= 1; self.in_flight += 1
+                        return
+                    if now >= deadline:
+                        raise UpstreamBusy(f"{self.name}: no capacity within {timeout}s ({len(self.waiting)} waiting, {self.in_flight} in flight)")
+                    # Nobody notifies when a token is due, so wake up for it.
+                    self._cond.wait(min(deadline - now, (1 - self.tokens) / self.rate) if self.tokens < 1 else deadline - now)
+            finally:
+                self.waiting.remove(ticket)
+                self._cond.notify_all()
+
+    def wake(self):
+        with self._cond: self._cond.notify_all()
+
+    def release(self, throttled):
+        with self._cond:
+            self.in_flight -= 1
+            self.limit = max(1.0, self.limit / 2) if throttled else min(self.max_concurrency, self.limit + 1 / self.limit)
+            self._cond.notify_all()
+
+    def snapshot(self):
+        with self._cond:
+            return {'waiting': [sum(1 for t in self.waiting if effective_priority(t)[0] == priority) for priority in (INTERACTIVE, BACKGROUND)],
+                    'in_flight': self.in_flight, 'limit': int(self.limit), 'tokens': round(self.tokens, 1)}
+
+upstream_lanes = {lane: UpstreamLane(lane, rate, UPSTREAM_CONCURRENCY.get(lane, 50)) for lane, rate in UPSTREAM_RATES.items()}
+
+def lane_gauges(field):
+    return lambda: [({'lane': name}, lane.snapshot()[field]) for name, lane in upstream_lanes.items()]
+
+metrics.gauge("locale_upstream_queue_depth", lambda: [({'lane': name, 'priority': PRIORITY_NAMES[i]}, n)
+                                                      for name, lane in upstream_lanes.items() for i, n in enumerate(lane.snapshot()['waiting'])])
+metrics.gauge("locale_upstream_in_flight", lane_gauges('in_flight'))
+metrics.gauge("locale_upstream_concurrency_limit", lane_gauges('limit'))
+
+def is_throttled(result=None, error=None):
+    """429s, 5xx and Google's OVER_QUERY_LIMIT, which it sends with a 200."""
+    status = getattr(error if error is not None else result, 'status_code', None)
+    if status is not None and (status == 429 or status >= 500): return True
+    return isinstance(result, requests.Response) and len(result.content) < 1024 and b'OVER_QUERY_LIMIT' in result.content
+
+def upstream_call(api, fn):
+    """Runs fn(), one request to api, through its lane at the caller's priority and returns its result.
+    Throttled answers are retried; after the last retry a throttled response is returned (or its error raised) as is."""
+    lane = upstream_lanes[UPSTREAM_LANES[api]]
+    priority = upstream_priority.get()
+    for attempt in range(UPSTREAM_RETRIES + 1):
+        waited = time.monotonic()
+        try:
+            lane.acquire(priority, UPSTREAM_WAIT_TIMEOUT, upstream_boosts.get())
+        except UpstreamBusy:
+            metrics.inc("locale_upstream_calls_total", api=api, outcome="busy"); raise
+        started, outcome, result, error = time.monotonic(), "ok", None, None
+        metrics.observe("locale_upstream_wait_seconds", started - waited, api=api, priority=PRIORITY_NAMES[priority])
+        try:
+            result = fn()
+            if is_throttled(result): outcome = "throttled"
+        except Exception as e:
+            error, outcome = e, "throttled" if is_throttled(error=e) else "error"
+        finally:
+            lane.release(outcome == "throttled")
+            metrics.inc("locale_upstream_calls_total", api=api, outcome=outcome)
+            metrics.observe("locale_upstream_seconds", time.monotonic() - started, api=api)
+        if outcome != "throttled" or attempt == UPSTREAM_RETRIES:
+            if error is not None: raise error
+            return result
+        metrics.inc("locale_upstream_retries_total", api=api)
+        time.sleep(random.uniform(0, UPSTREAM_RETRY_BASE * 2 ** attempt))
+
+def record_llm_sizes(call, prompt, response_text):
+    metrics.observe("locale_llm_prompt_bytes", len(prompt.encode()), buckets=SIZE_BUCKETS, call=call)
+    metrics.observe("locale_llm_response_bytes", len((response_text or "").encode()), buckets=SIZE_BUCKETS, call=call)
+
+def log_payload(label, payload_fn):
+    """Logs payload_fn() at DEBUG level when the current request was sampled for payload dumps."""
+    if g.get('sample_payloads'):
+        logger.debug("%s: %s", label, json.dumps(payload_fn(), default=str)[:DEBUG_PAYLOAD_MAX_CHARS])
+
+# --- Caching ---
+# A per-process LRU sits in front of a SQLite file shared by every gunicorn worker on the host.
+CACHE_DB_PATH = os.environ.get("CACHE_DB_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache.sqlite3"))
+PLACE_DETAILS_TTL = int(os.environ.get("PLACE_DETAILS_TTL", 24 * 3600))
+PLACE_DETAILS_STALE_TTL = int(os.environ.get("PLACE_DETAILS_STALE_TTL", 6 * 3600))
+PLACE_DETAILS_MEMORY_ENTRIES = int(os.environ.get("PLACE_DETAILS_MEMORY_ENTRIES", 2000))
+PLACE_DETAILS_DISK_ENTRIES = int(os.environ.get("PLACE_DETAILS_DISK_ENTRIES", 50000))
+
+class LRUCache:
+    """Thread-safe in-process LRU mapping key -> (stored_at, value)."""
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None: self._data.move_to_end(key)
+            return item
+
+    def set(self, key, stored_at, value):
+        with self._lock:
+            self._data[key] = (stored_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries: self._data.popitem(last=False)
+
+    def __len__(self):
+        return len(self._data)
+
+class DiskStore:
+    """JSON values in a SQLite table, bounded to max_entries (and optionally max_age seconds) by dropping the oldest rows."""
+    PRUNE_EVERY = 100
+
+    def __init__(self, path, table, max_entries, max_age=None):
+        self.path, self.table, self.max_entries, self.max_age = path, table, max_entries, max_age
+        self._local = threading.local()
+        self._shared_lock = threading.Lock()
+        self._writes = 0
+        self._execute(f"CREATE TABLE IF NOT EXISTS {table} (key TEXT PRIMARY KEY, stored_at REAL NOT NULL, value TEXT NOT NULL)")
+        self._execute(f"CREATE INDEX IF NOT EXISTS {table}_stored_at ON {table} (stored_at)")
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=not ASYNC_MODE)
+        conn.execute("PRAGMA journal_mode=WAL"); conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def _execute(self, sql, params=()):
+        if ASYNC_MODE:
+            # threading.local is per greenlet under gevent, i.e. per request, so greenlets share one connection.
+            with self._shared_lock:
+                if getattr(self, '_shared_conn', None) is None: self._shared_conn = self._connect()
+                return self._shared_conn.execute(sql, params).fetchall()
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = self._connect()
+        return conn.execute(sql, params).fetchall()
+
+    def get(self, key):
+        rows = self._execute(f"SELECT stored_at, value FROM {self.table} WHERE key = ?", (key,))
+        return (rows[0][0], json.loads(rows[0][1])) if rows else None
+
+    def set(self, key, stored_at, value):
+        self._execute(f"INSERT OR REPLACE INTO {self.table} (key, stored_at, value) VALUES (?, ?, ?)", (key, stored_at, json.dumps(value, separators=(',', ':'))))
+        self._writes += 1
+        if self._writes % self.PRUNE_EVERY == 0: self.prune()
+
+    def delete(self, key):
+        self._execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+
+    def touch(self, key, stored_at):
+        self._execute(f"UPDATE {self.table} SET stored_at = ? WHERE key = ?", (stored_at, key))
+
+    def prune(self):
+        if self.max_age is not None:
+            self._execute(f"DELETE FROM {self.table} WHERE stored_at < ?", (time.time() - self.max_age,))
+        self._execute(f"DELETE FROM {self.table} WHERE key IN (SELECT key FROM {self.table} ORDER BY stored_at DESC LIMIT -1 OFFSET ?)", (self.max_entries,))
+
+class SingleFlight:
+    """Lets one call per key run at a time; concurrent callers with the same key wait for it and share
+    its result or exception. Nothing is kept once the call finishes. When an interactive caller joins a
+    call led at background priority, the leader's upstream requests are promoted to interactive."""
+    def __init__(self, name):
+        self.name = name
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = Future()
+                call.boost = threading.Event()
+        if not leader:
+            metrics.inc("locale_coalesced_calls_total", call=self.name)
+            if upstream_priority.get() == INTERACTIVE and not call.boost.is_set():
+                call.boost.set()
+                for lane in upstream_lanes.values(): lane.wake()
+            return call.result()
+        boosts = upstream_boosts.set(upstream_boosts.get() + (call.boost,))
+        try:
+            value = fn()
+        except BaseException as e:
+            with self._lock: del self._calls[key]
+            call.set_exception(e); raise
+        finally:
+            upstream_boosts.reset(boosts)
+        with self._lock: del self._calls[key]
+        call.set_result(value)
+        return value
+
+class TieredCache:
+    """LRU + DiskStore with a TTL. Entries past the TTL but inside stale_ttl are served while a background refresh runs.
+    Concurrent misses for the same key share one fetch."""
+    def __init__(self, name, ttl, stale_ttl=0, max_memory=1000, max_disk=10000, persistent=True):
+        self.name, self.ttl, self.stale_ttl = name, ttl, stale_ttl
+        self.memory = LRUCache(max_memory)
+        self.disk = None
+        if persistent:
+            try:
+                self.disk = DiskStore(CACHE_DB_PATH, name, max_disk)
+            except sqlite3.Error as e:
+                logger.warning("Cache '%s' running without disk tier: %s", name, e)
+        self.stats = {"hits": 0, "stale_hits": 0, "misses": 0, "refreshes": 0}
+        self._refreshing = set()
+        self._inflight = SingleFlight(name)
+        self._lock = threading.Lock()
+
+    def _count(self, stat):
+        with self._lock: self.stats[stat] += 1
+        metrics.inc("locale_cache_lookups_total", cache=self.name, result=stat)
+
+    def _lookup(self, key):
+        item = self.memory.get(key)
+        if item is None and self.disk:
+            try:
+                item = self.disk.get(key)
+            except sqlite3.Error as e:
+                logger.warning("Cache '%s' disk read failed: %s", self.name, e); item = None
+            if item: self.memory.set(key, *item)
+        return item
+
+    def get(self, key):
+        """Returns a fresh cached value or None, without fetching."""
+        item = self._lookup(key)
+        if item and time.time() - item[0] < self.ttl:
+            self._count("hits"); return item[1]
+        self._count("misses"); return None
+
+    def set(self, key, value):
+        stored_at = time.time()
+        self.memory.set(key, stored_at, value)
+        if self.disk:
+            try:
+                self.disk.set(key, stored_at, value)
+            except sqlite3.Error as e:
+                logger.warning("Cache '%s' disk write failed: %s", self.name, e)
+
+    def get_or_fetch(self, key, fetch):
+        """Returns the cached value for key, calling fetch() on a miss. None results are not cached."""
+        item = self._lookup(key)
+        if item:
+            age = time.time() - item[0]
+            if age < self.ttl:
+                self._count("hits"); return item[1]
+            if age < self.ttl + self.stale_ttl:
+                self._count("stale_hits"); self._refresh_in_background(key, fetch); return item[1]
+        self._count("misses")
+        return self._inflight.do(key, lambda: self._fetch_and_store(key, fetch))
+
+    def _fetch_and_store(self, key, fetch):
+        value = fetch()
+        if value is not None: self.set(key, value)
+        return value
+
+    def _refresh_in_background(self, key, fetch):
+        with self._lock:
+            if key in self._refreshing: return
+            self._refreshing.add(key)
+        def refresh():
+            try:
+                value = fetch()
+                if value is not None: self.set(key, value)
+                self._count("refreshes")
+            except Exception as e:
+                logger.warning("Cache '%s' refresh of %s failed: %s", self.name, key, e)
+            finally:
+                with self._lock: self._refreshing.discard(key)
+        background_pool.submit(refresh)
+
+    def snapshot(self):
+        with self._lock: stats = dict(self.stats)
+        lookups = stats["hits"] + stats["stale_hits"] + stats["misses"]
+        stats["hit_rate"] = round((stats["hits"] + stats["stale_hits"]) / lookups, 4) if lookups else 0.0
+        stats["memory_entries"] = len(self.memory)
+        return stats
+
+MODERATION_TTL = int(os.environ.get("MODERATION_TTL", 7 * 24 * 3600))
+NEARBY_TTL = int(os.environ.get("NEARBY_TTL", 30 * 60))
+NEARBY_CELL_FRACTION = float(os.environ.get("NEARBY_CELL_FRACTION", 0.1))
+NEARBY_RADIUS_BUCKETS = (500, 1000, 1500, 3000, 5000, 8000, 15000, 20000, 30000, 50000)
+METERS_PER_DEGREE_LAT = 111320
+TRAVEL_ORIGIN_CELL_M = float(os.environ.get("TRAVEL_ORIGIN_CELL_M", 300))
+TRAVEL_MATRIX_TTL = int(os.environ.get("TRAVEL_MATRIX_TTL", 6 * 3600))
+
+def cache_gauges():
+    return [({'cache': c.name}, len(c.memory)) for c in (place_details_cache, nearby_cache, nearby_page2_cache, moderation_cache, travel_time_cache, photo_cache.index)]
+
+place_details_cache = TieredCache("place_details", PLACE_DETAILS_TTL, PLACE_DETAILS_STALE_TTL, PLACE_DETAILS_MEMORY_ENTRIES, PLACE_DETAILS_DISK_ENTRIES)
+nearby_cache = TieredCache("nearby_search", NEARBY_TTL, max_memory=500, max_disk=20000)
+# Only prefetching reads page 2, so its lookups are kept out of the nearby_search hit rate.
+nearby_page2_cache = TieredCache("nearby_search_page2", NEARBY_TTL, max_memory=500, max_disk=20000)
+moderation_cache = TieredCache("moderation", MODERATION_TTL, max_memory=5000, max_disk=50000)
+travel_time_cache = TieredCache("distance_matrix", TRAVEL_MATRIX_TTL, max_memory=5000, max_disk=50000)
+metrics.gauge("locale_cache_memory_entries", cache_gauges)
+
+# --- Sessions ---
+# The cookie only carries a random session id; the conversation lives server side. The memory backend
+# is per process, so deployments running several gunicorn workers should set SESSION_BACKEND=sqlite.
+SESSION_BACKEND = os.environ.get("SESSION_BACKEND", "memory")
+SESSION_TTL = int(os.environ.get("SESSION_TTL", 2 * 3600))
+SESSION_MAX_ENTRIES = int(os.environ.get("SESSION_MAX_ENTRIES", 100000))
+
+def encode_session(data):
+    return {k: {'__set__': sorted(v)} if isinstance(v, set) else v for k, v in data.items()}
+
+def decode_session(data):
+    return {k: set(v['__set__']) if isinstance(v, dict) and '__set__' in v else v for k, v in data.items()}
+
+class ServerSession(CallbackDict, SessionMixin):
+    def __init__(self, initial=None, sid=None, new=False):
+        def on_update(self): self.modified = True
+        super().__init__(initial, on_update)
+        self.sid, self.new, self.modified = sid, new, False
+
+class MemorySessionBackend:
+    """Sessions in a dict ordered by last use, so idle ones are evicted from the front."""
+    def __init__(self, ttl, max_entries):
+        self.ttl, self.max_entries = ttl, max_entries
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _evict(self, now):
+        while self._data and (len(self._data) > self.max_entries or next(iter(self._data.values()))[0] < now - self.ttl):
+            self._data.popitem(last=False)
+
+    def load(self, sid):
+        with self._lock:
+            item = self._data.get(sid)
+            if item is None or item[0] < time.time() - self.ttl: return None
+            return decode_session(item[1])
+
+    def save(self, sid, data):
+        now = time.time()
+        with self._lock:
+            self._data[sid] = (now, encode_session(data))
+            self._data.move_to_end(sid)
+            self._evict(now)
+
+    def touch(self, sid):
+        with self._lock:
+            if sid in self._data:
+                self._data[sid] = (time.time(), self._data[sid][1]); self._data.move_to_end(sid)
+
+    def delete(self, sid):
+        with self._lock: self._data.pop(sid, None)
+
+class SqliteSessionBackend:
+    """Sessions in the shared cache database, visible to every worker and kept across restarts."""
+    def __init__(self, ttl, max_entries):
+        self.ttl = ttl
+        self.store = DiskStore(CACHE_DB_PATH, "sessions", max_entries, max_age=ttl)
+
+    def load(self, sid):
+        item = self.store.get(sid)
+        if item is None or item[0] < time.time() - self.ttl: return None
+        return decode_session(item[1])
+
+    def save(self, sid, data):
+        self.store.set(sid, time.time(), encode_session(data))
+
+    def touch(self, sid):
+        self.store.touch(sid, time.time())
+
+    def delete(self, sid):
+        self.store.delete(sid)
+
+class ServerSideSessionInterface(SessionInterface):
+    def __init__(self, backend):
+        self.backend = backend
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(self.get_cookie_name(app))
+        data = self.backend.load(sid) if sid else None
+        if data is None:
+            return ServerSession(sid=secrets.token_urlsafe(24), new=True)
+        return ServerSession(data, sid=sid)
+
+    def save_session(self, app, session, response):
+        name, domain, path = self.get_cookie_name(app), self.get_cookie_domain(app), self.get_cookie_path(app)
+        if not session:
+            if not session.new:
+                self.backend.delete(session.sid)
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+        if session.modified or session.new:
+            self.persist(session)
+        else:
+            self.backend.touch(session.sid)
+        if session.new:
+            response.set_cookie(name, session.sid, httponly=self.get_cookie_httponly(app), secure=self.get_cookie_secure(app),
+                                samesite=self.get_cookie_samesite(app), domain=domain, path=path)
+
+    def persist(self, session):
+        """Writes the session now; used for changes made after a streamed response has started."""
+        self.backend.save(session.sid, dict(session))
+        session.modified = False
+
+session_backend = (SqliteSessionBackend if SESSION_BACKEND == "sqlite" else MemorySessionBackend)(SESSION_TTL, SESSION_MAX_ENTRIES)
+app.session_interface = ServerSideSessionInterface(session_backend)
+
+def session_summary():
+    turns = session['conversation'].count("\n") + 1 if 'conversation' in session else 0
+    return f"sid={session.sid[:8]} turns={turns} excluded={len(session.get('excluded_ids', ()))} retries={session.get('retries', 0)}"
+
 
 # --- The Plan Book ---
 plan_book = {
@@ -112,11 +731,114 @@ plan_book = {
 }
 
 
+# --- Precompiled Plan Keywords ---
+# A plan answered only through its multiple-choice questions produces one of a small, fixed set of
+# queries, so their refined keywords are built ahead of time (`flask --app app build-keyword-table`)
+# and looked up instead of calling the LLM. The table is tied to a hash of plan_book.
+# It is generated state, so it is written next to the cache database (by default the app directory,
+# where .gitignore keeps it out of commits); KEYWORD_TABLE_PATH moves it elsewhere.
+KEYWORD_TABLE_PATH = os.environ.get("KEYWORD_TABLE_PATH", os.path.join(os.path.dirname(os.path.abspath(CACHE_DB_PATH)), "keyword_table.json"))
+
+def build_plan_query(plan, answers, action='get_recommendations'):
+    initial_prompt = [plan['base_prompt']]
+    if action == 'get_recommendations':
+        for question in plan['questions']:
+            q_id = question['id']
+            if answers.get(q_id):
+                initial_prompt.append(f"For '{question['text']}', the user specified '{answers[q_id]}'.")
+    return " ".join(initial_prompt)
+
+def enumerate_plan_queries():
+    """Every query a plan can produce when its free-text questions are left blank."""
+    queries = set()
+    for plan in plan_book.values():
+        queries.add(build_plan_query(plan, {}, action='surprise_me'))
+        choices = [q for q in plan['questions'] if q['type'] == 'multiple_choice']
+        for combo in itertools.product(*[[None] + [o['value'] for o in q['options']] for q in choices]):
+            queries.add(build_plan_query(plan, {q['id']: value for q, value in zip(choices, combo)}))
+    return queries
+
+class KeywordTable:
+    """Initial plan query -> refined keyword, persisted as JSON and versioned by a hash of plan_book."""
+    def __init__(self, path):
+        self.path = path
+        self.version = hashlib.sha256(json.dumps(plan_book, sort_keys=True).encode()).hexdigest()[:16]
+        self.queries = enumerate_plan_queries()
+        self.keywords = self._load()
+        self._lock = threading.Lock()
+
+    def _load(self):
+        try:
+            with open(self.path) as f: data = json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            logger.warning("Ignoring unreadable keyword table: %s", e); return {}
+        if data.get('version') != self.version:
+            logger.warning("Keyword table is stale for the current plan_book; ignoring it."); return {}
+        return data.get('keywords', {})
+
+    def covers(self, query):
+        return query in self.queries
+
+    def lookup(self, query):
+        return self.keywords.get(query)
+
+    def add(self, query, keyword):
+        """Records a keyword and writes the table, merging entries other workers have saved meanwhile."""
+        with self._lock:
+            self.keywords = {**self._load(), **self.keywords, query: keyword}
+            tmp_path = f"{self.path}.{os.getpid()}.tmp"
+            try:
+                with open(tmp_path, 'w') as f:
+                    json.dump({'version': self.version, 'keywords': self.keywords}, f, indent=1, sort_keys=True)
+                os.replace(tmp_path, self.path)
+            except OSError as e:
+                logger.warning("Could not save keyword table: %s", e)
+
+keyword_table = KeywordTable(KEYWORD_TABLE_PATH)
+
+
 # --- Helper Functions ---
 
+# Obvious verdicts that never need the LLM. Anything not decided here goes to the LLM, and its
+# answer is cached by normalized query.
+MODERATION_DENY_TERMS = {"cocaine", "heroin", "fentanyl", "meth", "methamphetamine", "porn", "porno", "pornography"}
+MODERATION_ALLOW_TERMS = set("""
+a an the and or but with without for of in on at near to from by my our me we i im i'm us some any good great best nice
+cheap affordable budget expensive upscale fancy casual quiet cozy cosy lively fun romantic trendy modern classic local
+hidden gem gems new open late night early morning today tonight lunch dinner breakfast brunch dessert snack drinks
+place places spot spots restaurant restaurants cafe cafes coffee shop shops bar bars pub pubs bakery bistro diner
+pizza sushi tacos taco burger burgers ramen noodles thai indian italian mexican chinese japanese korean vietnamese
+french greek spanish mediterranean american vegan vegetarian seafood steak steakhouse bbq wine beer cocktails tea
+family kids friendly date birthday party group outdoor seating patio view rooftop wifi work study book parking
+wheelchair accessible something somewhere more less different another cheaper closer quieter better other
+""".split())
+
+def normalize_query(text):
+    return " ".join(re.findall(r"[\w']+", text.casefold()))
+
+def prefilter_moderation(user_input):
+    """Returns True/False for clear-cut queries, or None when the LLM has to decide."""
+    tokens = set(normalize_query(user_input).split())
+    if tokens & MODERATION_DENY_TERMS: return False
+    if keyword_table.covers(user_input) or (tokens and tokens <= MODERATION_ALLOW_TERMS): return True
+    return None
+
+@timed_stage("moderation")
 def moderate_query(user_input):
     if not user_input or not isinstance(user_input, str) or not user_input.strip():
         return False
+    verdict = prefilter_moderation(user_input)
+    metrics.inc("locale_moderation_decisions_total", source="llm_or_cache" if verdict is None else "prefilter")
+    if verdict is None:
+        key = normalize_query(user_input)
+        # Queries with no word characters (only emoji or symbols) would all share the key "", so they skip the cache.
+        verdict = moderation_cache.get_or_fetch(key, lambda: _llm_moderation_verdict(user_input)) if key else _llm_moderation_verdict(user_input)
+    return bool(verdict)
+
+def _llm_moderation_verdict(user_input):
+    """Asks the LLM. Returns None on failure so errors are refused without being cached."""
     moderation_prompt = f"""
     You are a content safety moderator for a local business search app. Your goal is to flag ONLY a very narrow set of harmful queries. You must allow searches for all legal businesses, including those for adults.
     ALLOWED (mark as "safe"): Any queries for legal businesses, including bars, wineries, breweries, strip clubs, adult stores, and cannabis dispensaries. Use of slang like "killer view" or "food to die for" is also safe.
@@ -128,11 +850,12 @@ def moderate_query(user_input):
     Query: "{user_input}"
     """
     try:
-        response = openai.chat.completions.create(model="gpt-3.5-turbo", messages=[{"role": "system", "content": "You are a content safety moderator."}, {"role": "user", "content": moderation_prompt}], temperature=0, max_tokens=5)
+        response = upstream_call("moderation", lambda: openai.chat.completions.create(model="gpt-3.5-turbo", messages=[{"role": "system", "content": "You are a content safety moderator."}, {"role": "user", "content": moderation_prompt}], temperature=0, max_tokens=5))
+        record_llm_sizes("moderation", moderation_prompt, response.choices[0].message.content)
         decision = response.choices[0].message.content.strip().lower().replace('"', '').replace('.', '')
         return decision == "safe"
     except Exception as e:
-        print(f"Moderation check failed: {e}"); return False
+        logger.warning("Moderation check failed: %s", e); return None
 
 def refine_query_with_llm(conversation_history):
     system_prompt = """
@@ -156,117 +879,584 @@ def refine_query_with_llm(conversation_history):
     Your response format MUST be a JSON object with two keys: "type" (either "question" or "keyword") and "content".
     """
     try:
-        response = openai.chat.completions.create(model="gpt-4o-mini", response_format={"type": "json_object"}, messages=[{"role": "system", "content": system_prompt}, {"role": "user", "content": conversation_history}])
-        return json.loads(response.choices[0].message.content)
-    except Exception as e:
-        print(f"Error in refine_query_with_llm: {e}"); return {"type": "error", "content": "Sorry, I had trouble refining your query."}
+        # Identical conversations in flight at once (a trending plan) share one completion.
+        return refine_flight.do(" ".join(conversation_history.split()), lambda: _request_refinement(system_prompt, conversation_history))
+    except Exception:
+        logger.exception("Error in refine_query_with_llm"); return {"type": "error", "content": "Sorry, I had trouble refining your query."}
 
-def get_nearby_places(location, keyword, radius):
-    url = "https://maps.googleapis.com/maps/api/place/nearbysearch/json"
+refine_flight = SingleFlight("refine")
+
+def _request_refinement(system_prompt, conversation_history):
+    response = upstream_call("refine", lambda: openai.chat.completions.create(model="gpt-4o-mini", response_format={"type": "json_object"}, messages=[{"role": "system", "content": system_prompt}, {"role": "user", "content": conversation_history}]))
+    record_llm_sizes("refine", system_prompt + conversation_history, response.choices[0].message.content)
+    return json.loads(response.choices[0].message.content)
+
+def haversine_m(lat1, lng1, lat2, lng2):
+    lat1, lng1, lat2, lng2 = map(math.radians, (lat1, lng1, lat2, lng2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2
+    return 2 * 6371000 * math.asin(math.sqrt(a))
+
+def normalize_keyword(keyword):
+    """Cache key for a keyword: its distinct words, sorted. Keywords without word characters are kept as written."""
+    words = sorted(set(re.findall(r"[\w']+", (keyword or "").casefold())))
+    return " ".join(words) if words else " ".join((keyword or "").split())
+
+def grid_cell(location, cell_m):
+    """Snaps a location to a grid of roughly cell_m squares. Returns the cell's (row, col) and its centre."""
+    lat_step = cell_m / METERS_PER_DEGREE_LAT
+    row = math.floor(location['lat'] / lat_step)
+    center_lat = (row + 0.5) * lat_step
+    lng_step = cell_m / (METERS_PER_DEGREE_LAT * max(math.cos(math.radians(center_lat)), 0.01))
+    col = math.floor(location['lng'] / lng_step)
+    return (row, col), {'lat': center_lat, 'lng': (col + 0.5) * lng_step}
+
+def nearby_search_cell(location, radius):
+    """Snaps a search to its radius bucket and a grid cell sized as a fraction of that bucket."""
+    bucket = next((b for b in NEARBY_RADIUS_BUCKETS if b >= radius), NEARBY_RADIUS_BUCKETS[-1])
+    cell_m = max(bucket * NEARBY_CELL_FRACTION, 50)
+    cell, center = grid_cell(location, cell_m)
+    return cell, center, bucket, cell_m
+
+def _request_nearby_places(location, keyword, radius):
+    url = f"{GOOGLE_MAPS_BASE_URL}/maps/api/place/nearbysearch/json"
     params = {'location': f"{location['lat']},{location['lng']}", 'radius': radius, 'keyword': keyword, 'key': GOOGLE_MAPS_API_KEY}
+    response = upstream_call("nearby_search", lambda: http.get(url, params=params, timeout=HTTP_TIMEOUT)); response.raise_for_status()
+    payload = response.json()
+    if payload.get('status', 'OK') not in ('OK', 'ZERO_RESULTS'):
+        logger.warning("Nearby Search returned %s: %s", payload.get('status'), payload.get('error_message', '')); return None
+    return payload
+
+@timed_stage("refinement")
+def refine_conversation(conversation_history, initial_query=None):
+    """refine_query_with_llm, answered from the keyword table when the conversation is an untouched plan query."""
+    if initial_query is None or not keyword_table.covers(initial_query):
+        return refine_query_with_llm(conversation_history)
+    keyword = keyword_table.lookup(initial_query)
+    metrics.inc("locale_keyword_table_lookups_total", result="hit" if keyword else "miss")
+    if keyword:
+        return {"type": "keyword", "content": keyword}
+    llm_response = refine_query_with_llm(conversation_history)
+    if llm_response.get("type") == "keyword":
+        keyword_table.add(initial_query, llm_response["content"])
+    return llm_response
+
+@timed_stage("nearby_search")
+def get_nearby_places(location, keyword, radius):
+    """Nearby Search shared by every search in the same grid cell, keyword and radius bucket.
+
+    The normalized keyword is only the cache key; Google gets the keyword as written. The cached
+    query is centred on the cell and widened by half the cell diagonal so it covers
+    every origin in the cell; results are then cut back to the caller's real origin and radius.
+    """
     try:
-        response = requests.get(url, params=params); response.raise_for_status(); return response.json()
-    except Exception as e:
-        print(f"Error in get_nearby_places: {e}"); return None
+        radius = int(radius)
+        cell, center, bucket, cell_m = nearby_search_cell(location, radius)
+        keyword_key = normalize_keyword(keyword)
+        key = f"{cell[0]}:{cell[1]}|{bucket}|{keyword_key}"
+        search_radius = min(int(bucket + cell_m * 0.71), NEARBY_RADIUS_BUCKETS[-1])
+        # Page tokens expire within minutes, so they are kept out of the cache: only the caller whose
+        # search went to Google gets one. Everyone gets page_key, under which page 2 is cached.
+        fresh = {}
+        def fetch():
+            payload = _request_nearby_places(center, keyword, search_radius)
+            if payload: fresh['next_page_token'] = payload.pop('next_page_token', None)
+            return payload
+        payload = nearby_cache.get_or_fetch(key, fetch)
+        if payload is None: return None
+        results = []
+        for p in payload.get('results', []):
+            loc = p.get('geometry', {}).get('location')
+            if loc and haversine_m(location['lat'], location['lng'], loc['lat'], loc['lng']) > radius: continue
+            results.append(p)
+        return {**payload, 'results': results, 'page_key': key, 'next_page_token': fresh.get('next_page_token')}
+    except Exception:
+        logger.exception("Error in get_nearby_places"); return None
+
+PLACE_DETAILS_FIELDS = 'name,place_id,rating,reviews,photos,user_ratings_total,price_level,types,editorial_summary,wheelchair_accessible_entrance'
 
-def get_place_details_and_photos(place_id):
-    details_url = "https://maps.googleapis.com/maps/api/place/details/json"
-    fields_to_request = 'name,place_id,rating,reviews,photos,user_ratings_total,price_level,types,editorial_summary,wheelchair_accessible_entrance'
-    params = {'place_id': place_id, 'fields': fields_to_request, 'key': GOOGLE_MAPS_API_KEY}
+def _request_place_details(place_id, fields):
+    details_url = f"{GOOGLE_MAPS_BASE_URL}/maps/api/place/details/json"
+    params = {'place_id': place_id, 'fields': fields, 'key': GOOGLE_MAPS_API_KEY}
+    response = upstream_call("place_details", lambda: http.get(details_url, params=params, timeout=HTTP_TIMEOUT)); response.raise_for_status()
+    return response.json().get('result') or None
+
+def get_place_details_and_photos(place_id, fields=PLACE_DETAILS_FIELDS):
     try:
-        response = requests.get(details_url, params=params); response.raise_for_status()
-        details = response.json().get('result', {})
-        details['photo_urls'] = [f"https://maps.googleapis.com/maps/api/place/photo?maxwidth=400&photoreference={p.get('photo_reference')}&key={GOOGLE_MAPS_API_KEY}" for p in details.get('photos', [])[:3]]
+        cached = place_details_cache.get_or_fetch(f"{place_id}|{fields}", lambda: _request_place_details(place_id, fields))
+        if cached is None: return None
+        # Copy so per-request fields never leak back into the cached entry.
+        details = dict(cached)
+        details['photo_urls'] = [photo_url(p['photo_reference']) for p in details.get('photos', [])[:3] if p.get('photo_reference')]
         return details
-    except Exception as e:
-        print(f"Error in get_place_details_and_photos: {e}"); return None
+    except Exception:
+        logger.exception("Error in get_place_details_and_photos"); return None
+
+@timed_stage("details")
+def fetch_place_details(place_ids):
+    """Fetches details for all place_ids concurrently. Failed or slow lookups are dropped, order is kept."""
+    futures = [details_pool.submit(get_place_details_and_photos, pid) for pid in place_ids]
+    done, not_done = wait(futures, timeout=FETCH_STAGE_TIMEOUT)
+    for f in not_done:
+        f.cancel()
+    if not_done:
+        logger.warning("fetch_place_details: %d of %d lookups timed out", len(not_done), len(futures))
+    return [f.result() for f in futures if f in done and f.result()]
+
+# Travel times are estimated from Nearby Search geometry: straight-line distance stretched by a detour
+# factor, at an average urban driving speed, plus a fixed overhead. Distance Matrix is only asked when
+# an estimate is close enough to a convenience threshold that its error could move the score.
+TRAVEL_DETOUR_FACTOR = float(os.environ.get("TRAVEL_DETOUR_FACTOR", 1.4))
+TRAVEL_SPEED_MPS = float(os.environ.get("TRAVEL_SPEED_MPS", 8.0))
+TRAVEL_OVERHEAD_SECONDS = float(os.environ.get("TRAVEL_OVERHEAD_SECONDS", 120))
+TRAVEL_THRESHOLD_MARGIN = float(os.environ.get("TRAVEL_THRESHOLD_MARGIN", 0.25))
+MATRIX_MAX_DESTINATIONS = 25
+
+def format_duration(seconds):
+    """Distance Matrix style text: '1 min', '12 mins', '1 hour 5 mins'."""
+    minutes = max(1, round(seconds / 60))
+    hours, minutes = divmod(minutes, 60)
+    text = f"{minutes} min{'s' if minutes != 1 else ''}"
+    if not hours: return text
+    return f"{hours} hour{'s' if hours != 1 else ''}" + (f" {text}" if minutes else "")
+
+def travel_time(seconds, estimated):
+    return {'text': ("~" if estimated else "") + format_duration(seconds), 'seconds': round(seconds), 'estimated': estimated}
+
+def estimate_travel_seconds(origin, locations):
+    """Estimated driving seconds to each location, None where a location is missing."""
+    return [None if loc is None else TRAVEL_OVERHEAD_SECONDS + haversine_m(origin['lat'], origin['lng'], loc['lat'], loc['lng']) * TRAVEL_DETOUR_FACTOR / TRAVEL_SPEED_MPS
+            for loc in locations]
+
+def near_threshold(seconds):
+    return any(abs(seconds - t) <= t * TRAVEL_THRESHOLD_MARGIN for t in (CONVENIENCE_BEST_SECONDS, CONVENIENCE_WORST_SECONDS))
+
+def _request_travel_times(origin, place_ids):
+    """One Distance Matrix row as {place_id: seconds}, for the destinations that resolved."""
+    url = f"{GOOGLE_MAPS_BASE_URL}/maps/api/distancematrix/json"
+    params = {'origins': f"{origin['lat']:.6f},{origin['lng']:.6f}", 'destinations': '|'.join([f"place_id:{pid}" for pid in place_ids]), 'key': GOOGLE_MAPS_API_KEY}
+    response = upstream_call("distance_matrix", lambda: http.get(url, params=params, timeout=HTTP_TIMEOUT)); response.raise_for_status()
+    rows = response.json().get('rows') or [{}]
+    return {pid: e['duration']['value'] for pid, e in zip(place_ids, rows[0].get('elements', [])) if e.get('status') == 'OK' and 'duration' in e}
+
+@timed_stage("travel_times")
+def get_travel_times(origin, places):
+    """Driving time per place as {'text': '12 mins', 'seconds': 720, 'estimated': False}.
+
+    places are Nearby Search results (or anything with a place_id). Places without geometry, or whose
+    estimate is near a threshold, are looked up in Distance Matrix from the centre of the origin's grid
+    cell, and the answers are cached per cell and place. If the lookup fails the estimate is kept.
+    """
+    places = [p for p in places if p.get('place_id')]
+    if not places: return {}
+    cell, center = grid_cell(origin, TRAVEL_ORIGIN_CELL_M)
+    estimates = estimate_travel_seconds(origin, [p.get('geometry', {}).get('location') for p in places])
+    times, to_confirm = {}, []
+    for p, estimate in zip(places, estimates):
+        if estimate is not None and not near_threshold(estimate):
+            times[p['place_id']] = travel_time(estimate, True)
+            continue
+        seconds = travel_time_cache.get(f"{cell[0]}:{cell[1]}|{p['place_id']}")
+        if seconds is not None: times[p['place_id']] = travel_time(seconds, False)
+        else: to_confirm.append((p['place_id'], estimate))
+    for start in range(0, len(to_confirm), MATRIX_MAX_DESTINATIONS):
+        batch = to_confirm[start:start + MATRIX_MAX_DESTINATIONS]
+        try:
+            matrix = _request_travel_times(center, [pid for pid, _ in batch])
+        except Exception as e:
+            logger.warning("Distance Matrix lookup failed, keeping estimates: %s", e); matrix = {}
+        for pid, estimate in batch:
+            if pid in matrix:
+                travel_time_cache.set(f"{cell[0]}:{cell[1]}|{pid}", matrix[pid])
+                times[pid] = travel_time(matrix[pid], False)
+            elif estimate is not None:
+                times[pid] = travel_time(estimate, True)
+    metrics.inc("locale_travel_times_total", sum(t['estimated'] for t in times.values()), source="estimate")
+    metrics.inc("locale_travel_times_total", sum(not t['estimated'] for t in times.values()), source="distance_matrix")
+    return times
 
-def get_travel_times(origin, place_ids):
-    if not place_ids: return {}
-    url = "https://maps.googleapis.com/maps/api/distancematrix/json"
-    params = {'origins': f"{origin['lat']},{origin['lng']}", 'destinations': '|'.join([f"place_id:{pid}" for pid in place_ids]), 'key': GOOGLE_MAPS_API_KEY}
+# --- Local Ranking ---
+# Quality and convenience are arithmetic on rating, review count and travel time, so they are scored
+# here. The LLM only judges relevance and vibe for the top-K places, from review sentences chosen
+# under a token budget.
+RANKING_TOP_K = int(os.environ.get("RANKING_TOP_K", 6))
+RANKING_REVIEW_TOKEN_BUDGET = int(os.environ.get("RANKING_REVIEW_TOKEN_BUDGET", 900))
+RANKING_WEIGHTS = {'relevance': 0.35, 'vibe': 0.25, 'quality': 0.2, 'convenience': 0.2}
+CHARS_PER_TOKEN = 4
+RATING_PRIOR, RATING_PRIOR_COUNT = 4.0, 50
+CONVENIENCE_BEST_SECONDS, CONVENIENCE_WORST_SECONDS = 10 * 60, 45 * 60
+STOPWORDS = {"a", "an", "the", "and", "or", "for", "of", "in", "on", "at", "to", "with", "is", "it", "that", "this", "be",
+             "user", "user's", "users", "initial", "request", "specified", "answer", "my", "new", "was", "not", "satisfied", "what's"}
+
+def query_terms(text):
+    return {t for t in normalize_query(text).split() if t not in STOPWORDS and len(t) > 2}
+
+def travel_minutes(travel):
+    return round(travel['seconds'] / 60) if travel and travel.get('seconds') is not None else None
+
+def clamp_score(value):
+    return max(1.0, min(10.0, value))
+
+def llm_score(value, default=5.0):
+    """A 1-10 score from LLM output, which may be a number, a string like "8" or "8/10", null or missing."""
+    match = re.match(r"\s*(\d+(?:\.\d+)?)", value) if isinstance(value, str) else None
     try:
-        response = requests.get(url, params=params); response.raise_for_status()
-        matrix = response.json()
-        return {place_ids[i]: r.get('duration', {}).get('text', 'N/A') for i, r in enumerate(matrix.get('rows', [{}])[0].get('elements', [])) if r.get('status') == 'OK'}
-    except Exception as e:
-        print(f"Error getting travel times: {e}"); return {}
+        score = float(match.group(1) if match else value)
+    except (TypeError, ValueError):
+        return default
+    return clamp_score(score) if math.isfinite(score) else default
+
+def score_places(places_data, travel_times_map, terms):
+    """Local sub-scores for every place as parallel lists: quality, convenience and lexical match (all 1-10)."""
+    ratings = [p.get('rating') for p in places_data]
+    counts = [p.get('user_ratings_total') or 0 for p in places_data]
+    seconds = [travel_times_map.get(p.get('place_id'), {}).get('seconds') for p in places_data]
+    texts = [" ".join([p.get('name', ''), " ".join(p.get('types', [])), p.get('editorial_summary', {}).get('overview', '')]
+                      + [r.get('text', '') for r in p.get('reviews', [])]) for p in places_data]
+    # Ratings are shrunk towards the prior so a 5.0 from three reviews does not beat a 4.6 from two thousand.
+    quality = [clamp_score(1 + 9 * (((c * r + RATING_PRIOR_COUNT * RATING_PRIOR) / (c + RATING_PRIOR_COUNT)) - 3.0) / 2.0) if r else 1.0
+               for r, c in zip(ratings, counts)]
+    span = CONVENIENCE_WORST_SECONDS - CONVENIENCE_BEST_SECONDS
+    convenience = [5.0 if t is None else clamp_score(10 - 9 * (t - CONVENIENCE_BEST_SECONDS) / span) for t in seconds]
+    lexical = [clamp_score(1 + 9 * len(terms & set(normalize_query(t).split())) / len(terms)) if terms else 5.0 for t in texts]
+    return quality, convenience, lexical
+
+def select_review_sentences(place, terms, token_budget):
+    """The review sentences sharing the most terms with the query, in review order, within token_budget."""
+    sentences = [s.strip() for r in place.get('reviews', []) for s in re.split(r'(?<=[.!?])\s+', r.get('text', '')) if len(s.strip()) > 15]
+    ranked = sorted(range(len(sentences)), key=lambda i: (-len(terms & set(normalize_query(sentences[i]).split())), i))
+    chosen, budget = [], token_budget * CHARS_PER_TOKEN
+    for i in ranked:
+        sentence = sentences[i][:300]
+        if len(sentence) > budget: continue
+        chosen.append(i); budget -= len(sentence)
+    return [sentences[i][:300] for i in sorted(chosen)]
 
-def get_final_recommendation(conversation_history, places_data, origin):
+class RankingAbandoned(Exception):
+    """Raised into a streamed ranking whose client has disconnected."""
+
+@timed_stage("ranking")
+def get_final_recommendation(conversation_history, places_data, origin, travel_times_map=None, on_progress=None):
+    """Ranks places_data. on_progress, if given, receives {'scored': n, 'total': k} while the LLM output streams in;
+    an exception raised by on_progress abandons the stream."""
+    places_data = [p for p in places_data or [] if p.get('place_id')]
     if not places_data: return None
-    place_ids_to_rank = [p['place_id'] for p in places_data if 'place_id' in p]
-    if not place_ids_to_rank: return None
-    travel_times_map = get_travel_times(origin, place_ids_to_rank)
+    if travel_times_map is None:
+        travel_times_map = get_travel_times(origin, places_data)
+
+    terms = query_terms(conversation_history)
+    quality, convenience, lexical = score_places(places_data, travel_times_map, terms)
+    local_scores = {p['place_id']: {'quality_score': round(q, 1), 'convenience_score': round(c, 1), 'lexical_score': l}
+                    for p, q, c, l in zip(places_data, quality, convenience, lexical)}
+    prerank = sorted(places_data, key=lambda p: (-(0.4 * local_scores[p['place_id']]['lexical_score']
+                                                   + 0.3 * local_scores[p['place_id']]['quality_score']
+                                                   + 0.3 * local_scores[p['place_id']]['convenience_score']), p['place_id']))
+    candidates = prerank[:RANKING_TOP_K]
+
+    per_place_budget = RANKING_REVIEW_TOKEN_BUDGET // len(candidates)
     lean_data_for_llm = []
-    total_reviews = 0
-    for p in places_data:
-        place_id = p.get('place_id')
-        if place_id:
-            # Truncate each review to 200 characters
-            reviews = [r.get('text', '')[:200] for r in p.get('reviews', [])[:5]]
-            total_reviews += len(reviews)
-            lean_data_for_llm.append({
-                'place_id': place_id, 'name': p.get('name'), 'types': p.get('types', []),
-                'rating': p.get('rating'), 'review_count': p.get('user_ratings_total'),
-                'price_level': p.get('price_level'), 'travel_time': travel_times_map.get(place_id, 'N/A'),
-                'wheelchair_accessible': p.get('wheelchair_accessible_entrance'),
-                'summary': p.get('editorial_summary', {}).get('overview', 'No summary available.'),
-                'reviews': reviews
-            })
-    import sys
-    import json as _json
-    print(f"[DEBUG] Number of places sent to LLM: {len(lean_data_for_llm)}")
-    print(f"[DEBUG] Total reviews sent to LLM: {total_reviews}")
-    print(f"[DEBUG] Estimated JSON size sent to LLM: {len(_json.dumps(lean_data_for_llm))} bytes")
+    for p in candidates:
+        lean_data_for_llm.append({
+            'place_id': p['place_id'], 'name': p.get('name'), 'types': p.get('types', [])[:4],
+            'price_level': p.get('price_level'), 'travel_minutes': travel_minutes(travel_times_map.get(p['place_id'])),
+            'wheelchair_accessible': p.get('wheelchair_accessible_entrance'),
+            'summary': p.get('editorial_summary', {}).get('overview'),
+            'reviews': select_review_sentences(p, terms, per_place_budget)
+        })
 
     system_prompt = """
-    You are an expert local guide and recommendation concierge. Your goal is to analyze a list of potential places and rank them according to a user's specific request. You must provide a structured, reasoned analysis for your rankings.
+    You are an expert local guide and recommendation concierge. Your goal is to judge how well each place in a list matches a user's specific request. Ratings and travel times have already been scored separately; judge only the fit.
 
     **TASK:**
     1.  Analyze the user's conversation history to deeply understand their needs (e.g., ambiance, price, occasion, specific features).
-    2.  For each place in the provided JSON data, evaluate it based on the user's request.
-    3.  You will score each place on FOUR criteria, from 1 (poor match) to 10 (perfect match):
+    2.  For each place in the provided JSON data, score it on TWO criteria, from 1 (poor match) to 10 (perfect match):
         - **Relevance Score**: How well do the place's `types`, `summary`, and `reviews` match the user's explicit request (e.g., "cozy cafe", "romantic italian restaurant")?
-        - **Quality Score**: A combination of the `rating` and `review_count`. A high rating with many reviews is a 10. A low rating or very few reviews is a 1.
         - **Vibe Score**: Based on the language in the `reviews`, does the atmosphere (e.g., "lively", "quiet", "trendy", "family-friendly") match the implicit mood of the user's request?
-        - **Convenience Score**: Based on the `travel_time`. A shorter travel time gets a higher score (e.g., <10 mins is a 10, >45 mins is a 1).
-    4.  Provide a `final_score` which is a weighted average of the four scores.
-    5.  Write a concise `justification` (20-30 words) for your ranking, explaining why this place is a good match, considering all factors including travel time.
-    6.  Return a single JSON object containing a key "ranked_recommendations". The value should be a list of all analyzed places, sorted from highest `final_score` to lowest.
+    3.  Write a concise `justification` (20-30 words) explaining why this place is a good match, considering all factors including travel time.
+    4.  Return a single JSON object containing a key "ranked_recommendations" with one entry for every place.
 
     **OUTPUT FORMAT (Strict):**
-    { "ranked_recommendations": [ { "place_id": "string", "name": "string", "relevance_score": integer, "quality_score": integer, "vibe_score": integer, "convenience_score": integer, "final_score": float, "justification": "string" }, ... ] }
+    { "ranked_recommendations": [ { "place_id": "string", "relevance_score": integer, "vibe_score": integer, "justification": "string" }, ... ] }
     """
-    user_prompt = f"User's conversation history:\n---\n{conversation_history}\n---\n\nData for the places to rank:\n---\n{json.dumps(lean_data_for_llm, indent=2)}\n---\n\nPlease provide your ranked analysis in the specified JSON format."
+    places_json = json.dumps(lean_data_for_llm, separators=(',', ':'))
+    user_prompt = f"User's conversation history:\n---\n{conversation_history}\n---\n\nData for the places to rank:\n---\n{places_json}\n---\n\nPlease provide your analysis in the specified JSON format."
+    metrics.inc("locale_ranking_places_total", len(lean_data_for_llm))
+    metrics.inc("locale_ranking_review_sentences_total", sum(len(p['reviews']) for p in lean_data_for_llm))
+    logger.debug("Ranking %d of %d places with a %d byte prompt", len(lean_data_for_llm), len(places_data), len(user_prompt.encode()))
 
     try:
-        response = openai.chat.completions.create(model="gpt-4o-mini", response_format={"type": "json_object"}, messages=[{"role": "system", "content": system_prompt}, {"role": "user", "content": user_prompt}])
-        llm_output = json.loads(response.choices[0].message.content)
-        ranked_recs_from_llm = llm_output.get("ranked_recommendations", [])
-        if not ranked_recs_from_llm: return None
-        full_data_map = {p.get('place_id'): p for p in places_data}
+        messages = [{"role": "system", "content": system_prompt}, {"role": "user", "content": user_prompt}]
+        attempts = itertools.count()
+        def complete():
+            # The stream is read inside the call so it keeps its in-flight slot until the last chunk.
+            if on_progress is None:
+                response = openai.chat.completions.create(model="gpt-4o-mini", response_format={"type": "json_object"}, temperature=0, messages=messages)
+                return response.choices[0].message.content
+            if next(attempts):
+                # A retried stream starts over, so tell the client its earlier progress is void.
+                on_progress({'scored': 0, 'total': len(candidates), 'restarted': True})
+            content, scored = "", 0
+            with openai.chat.completions.create(model="gpt-4o-mini", response_format={"type": "json_object"}, temperature=0, messages=messages, stream=True) as stream:
+                for chunk in stream:
+                    content += (chunk.choices[0].delta.content or "") if chunk.choices else ""
+                    if content.count('"justification"') > scored:
+                        scored = content.count('"justification"')
+                        on_progress({'scored': scored, 'total': len(candidates)})
+            return content
+        content = upstream_call("ranking", complete)
+        record_llm_sizes("ranking", system_prompt + user_prompt, content)
+        llm_output = json.loads(content)
+        llm_scores = {item.get('place_id'): item for item in llm_output.get("ranked_recommendations", []) if isinstance(item, dict)}
+        if not llm_scores: return None
         final_recs = []
-        for llm_item in ranked_recs_from_llm:
-            pid = llm_item.get('place_id')
-            if pid and pid in full_data_map:
-                place_data = full_data_map[pid]
-                place_name = urllib.parse.quote_plus(place_data.get('name', ''))
-                place_data['link'] = f"https://www.google.com/maps/search/?api=1&query={place_name}&query_place_id={pid}"
-                place_data['travel_time'] = travel_times_map.get(pid, 'N/A')
-                final_recs.append(place_data)
+        for place_data in candidates:
+            pid = place_data['place_id']
+            llm_item = llm_scores.get(pid, {})
+            scores = {'relevance_score': llm_score(llm_item.get('relevance_score')), 'vibe_score': llm_score(llm_item.get('vibe_score')), **local_scores[pid]}
+            scores['final_score'] = round(sum(weight * float(scores[f"{name}_score"]) for name, weight in RANKING_WEIGHTS.items()), 2)
+            place_name = urllib.parse.quote_plus(place_data.get('name', ''))
+            place_data.update(scores)
+            place_data['justification'] = llm_item.get('justification', '')
+            place_data['link'] = f"https://www.google.com/maps/search/?api=1&query={place_name}&query_place_id={pid}"
+            place_data['travel_time'] = travel_times_map.get(pid, {}).get('text', 'N/A')
+            place_data['travel_seconds'] = travel_times_map.get(pid, {}).get('seconds')
+            place_data['travel_estimated'] = travel_times_map.get(pid, {}).get('estimated', False)
+            final_recs.append(place_data)
+        final_recs.sort(key=lambda p: (-p['final_score'], p['place_id']))
         return {"recommendations": final_recs}
+    except RankingAbandoned:
+        return None
+    except Exception:
+        logger.exception("Error in get_final_recommendation"); return None
+
+# --- Candidate Prefetch ---
+# After a response is sent, the places the user has not seen yet (the rest of Nearby Search and its
+# next page) are detailed in the background, so a retry with the same keyword is ranked from them.
+PREFETCH_WORKERS = int(os.environ.get("PREFETCH_WORKERS", 100 if ASYNC_MODE else 4))
+PREFETCH_MIN_READY = int(os.environ.get("PREFETCH_MIN_READY", 3))
+# Each pool holds a few dozen detailed places, and most sessions end by closing the tab, so pools are capped as well as aged out.
+PREFETCH_MAX_POOLS = int(os.environ.get("PREFETCH_MAX_POOLS", 1000))
+PREFETCH_MAX_ORIGIN_SHIFT_M = 250
+NEXT_PAGE_TOKEN_DELAY = 2.0
+
+prefetch_pool = ThreadPoolExecutor(max_workers=PREFETCH_WORKERS, thread_name_prefix="prefetch", initializer=lambda: upstream_priority.set(BACKGROUND))
+candidate_pools = OrderedDict()
+candidate_pools_lock = threading.Lock()
+metrics.gauge("locale_candidate_pools", lambda: [({}, len(candidate_pools))])
+
+def get_next_page_places(page_token):
+    """Next page of a Nearby Search. Callers wait NEXT_PAGE_TOKEN_DELAY first, as a fresh token needs a
+    moment to become valid; INVALID_REQUEST after that means the token is stale and is not retried."""
+    url = f"{GOOGLE_MAPS_BASE_URL}/maps/api/place/nearbysearch/json"
+    response = upstream_call("nearby_search", lambda: http.get(url, params={'pagetoken': page_token, 'key': GOOGLE_MAPS_API_KEY}, timeout=HTTP_TIMEOUT))
+    response.raise_for_status()
+    payload = response.json()
+    return payload if payload.get('status') in ('OK', 'ZERO_RESULTS') else None
+
+class CandidatePool:
+    """Unseen places for one session's keyword, origin and radius, filled in by background tasks."""
+    def __init__(self, keyword, location, radius):
+        self.keyword_key, self.location, self.radius = normalize_keyword(keyword), location, radius
+        self.details, self.travel_times = {}, {}
+        self.cancelled = threading.Event()
+        self.futures = []
+        self.last_used = time.time()
+        self._lock = threading.Lock()
+
+    def matches(self, keyword, location, radius):
+        return (bool(self.keyword_key) and normalize_keyword(keyword) == self.keyword_key and radius >= self.radius
+                and haversine_m(location['lat'], location['lng'], self.location['lat'], self.location['lng']) <= PREFETCH_MAX_ORIGIN_SHIFT_M)
+
+    def ready(self, excluded_ids):
+        """Copies of the detailed places not in excluded_ids, and their travel times."""
+        with self._lock:
+            places = [dict(d) for pid, d in self.details.items() if pid not in excluded_ids]
+            return places, {p['place_id']: self.travel_times[p['place_id']] for p in places if p['place_id'] in self.travel_times}
+
+    def add(self, details=(), travel_times=None):
+        with self._lock:
+            for d in details: self.details[d['place_id']] = d
+            self.travel_times.update(travel_times or {})
+
+    def submit(self, fn, *args):
+        if not self.cancelled.is_set():
+            self.futures.append(prefetch_pool.submit(self._run, fn, *args))
+
+    def _run(self, fn, *args):
+        if self.cancelled.is_set(): return
+        try:
+            fn(*args)
+        except Exception as e:
+            logger.warning("Prefetch task %s failed: %s", fn.__name__, e)
+
+    def prefetch(self, places):
+        self.submit(lambda: self.add(travel_times=get_travel_times(self.location, places)))
+        for p in places:
+            self.submit(lambda pid=p['place_id']: self.add(details=[d for d in [get_place_details_and_photos(pid)] if d]))
+
+    def prefetch_next_page(self, page_key, page_token, known_ids):
+        """Page 2 of the Nearby Search, from the cache or, given a token from a fresh search, from Google."""
+        payload = nearby_page2_cache.get(page_key)
+        if payload is None and page_token:
+            if self.cancelled.wait(NEXT_PAGE_TOKEN_DELAY): return
+            payload = get_next_page_places(page_token)
+            if payload: nearby_page2_cache.set(page_key, payload)
+        if not payload: return
+        places = []
+        for p in payload.get('results', []):
+            loc = p.get('geometry', {}).get('location')
+            if not p.get('place_id') or p['place_id'] in known_ids: continue
+            if loc and haversine_m(self.location['lat'], self.location['lng'], loc['lat'], loc['lng']) > self.radius: continue
+            places.append(p)
+        if places: self.prefetch(places)
+
+    def cancel(self):
+        self.cancelled.set()
+        for f in self.futures: f.cancel()
+
+def start_prefetch(sid, keyword, location, radius, nearby_payload, excluded_ids, detailed_places, travel_times_map):
+    """Replaces the session's candidate pool with the places it has not been shown yet and starts filling it."""
+    pool = CandidatePool(keyword, location, radius)
+    pool.add([d for d in detailed_places if d['place_id'] not in excluded_ids], travel_times_map)
+    known_ids = set(excluded_ids) | {d['place_id'] for d in detailed_places}
+    pool.prefetch([p for p in nearby_payload.get('results', []) if p.get('place_id') and p['place_id'] not in known_ids])
+    if nearby_payload.get('page_key'):
+        pool.submit(pool.prefetch_next_page, nearby_payload['page_key'], nearby_payload.get('next_page_token'),
+                    known_ids | {p.get('place_id') for p in nearby_payload['results']})
+    with candidate_pools_lock:
+        previous = candidate_pools.pop(sid, None)
+        candidate_pools[sid] = pool
+        evict_candidate_pools()
+    if previous: previous.cancel()
+
+def evict_candidate_pools():
+    """Drops pools idle for SESSION_TTL and, past PREFETCH_MAX_POOLS, the least recently used. Call with candidate_pools_lock held."""
+    while candidate_pools and (len(candidate_pools) > PREFETCH_MAX_POOLS
+                               or next(iter(candidate_pools.values())).last_used < time.time() - SESSION_TTL):
+        candidate_pools.popitem(last=False)[1].cancel()
+
+def get_candidate_pool(sid, keyword, location, radius):
+    with candidate_pools_lock:
+        evict_candidate_pools()
+        pool = candidate_pools.get(sid)
+        if pool is None or not pool.matches(keyword, location, radius): return None
+        pool.last_used = time.time()
+        candidate_pools.move_to_end(sid)
+        return pool
+
+def cancel_prefetch(sid):
+    with candidate_pools_lock: pool = candidate_pools.pop(sid, None)
+    if pool: pool.cancel()
+
+def end_session():
+    cancel_prefetch(session.sid)
+    session.clear()
+
+
+# --- Photo Proxy ---
+# Cards load photos through /photo/<ref> so the Maps key never reaches the browser. Each reference is
+# fetched once, re-encoded at card size when Pillow is installed, and kept on disk under a byte budget.
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+PHOTO_CACHE_DIR = os.environ.get("PHOTO_CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "photo_cache"))
+PHOTO_CACHE_MAX_BYTES = int(os.environ.get("PHOTO_CACHE_MAX_BYTES", 256 * 1024 * 1024))
+PHOTO_WIDTH = int(os.environ.get("PHOTO_WIDTH", 400))
+PHOTO_JPEG_QUALITY = int(os.environ.get("PHOTO_JPEG_QUALITY", 80))
+PHOTO_MAX_AGE = int(os.environ.get("PHOTO_MAX_AGE", 30 * 24 * 3600))
+PHOTO_REF_PATTERN = re.compile(r"[A-Za-z0-9_-]{1,2048}")
+# Photo URLs are signed so /photo only spends quota on references this app handed out. The key must agree across
+# workers and restarts (signed URLs live in the details cache), so without SECRET_KEY it is derived from the Maps key.
+PHOTO_SIGNING_KEY = hashlib.sha256(b"locale-photo|" + (os.environ.get("SECRET_KEY") or GOOGLE_MAPS_API_KEY or "").encode()).digest()
+
+def sign_photo_ref(photo_reference):
+    return hmac.new(PHOTO_SIGNING_KEY, photo_reference.encode(), hashlib.sha256).hexdigest()[:32]
+
+def photo_url(photo_reference):
+    return f"/photo/{photo_reference}?sig={sign_photo_ref(photo_reference)}"
+
+def shrink_photo(data, mimetype):
+    """Downscales to PHOTO_WIDTH and re-encodes as JPEG, keeping the original if that is smaller or Pillow is missing."""
+    if Image is None: return data, mimetype
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            image.thumbnail((PHOTO_WIDTH, PHOTO_WIDTH * 4))
+            out = io.BytesIO()
+            image.convert("RGB").save(out, "JPEG", quality=PHOTO_JPEG_QUALITY, optimize=True, progressive=True)
     except Exception as e:
-        print(f"Error in get_final_recommendation: {e}"); return None
+        logger.warning("Could not re-encode photo: %s", e); return data, mimetype
+    return (out.getvalue(), "image/jpeg") if out.tell() < len(data) else (data, mimetype)
+
+class PhotoCache:
+    """Photo files named by a hash of their reference, indexed by a TieredCache holding etag and mimetype.
+    A file's mtime is bumped whenever it is served, and prune() deletes the stalest past max_bytes."""
+    PRUNE_EVERY = 50
+
+    def __init__(self, directory, max_bytes):
+        self.directory, self.max_bytes = directory, max_bytes
+        os.makedirs(directory, exist_ok=True)
+        self.index = TieredCache("photos", PHOTO_MAX_AGE, max_memory=5000, max_disk=100000)
+        self._inflight = SingleFlight("photo")
+        self._writes = 0
+
+    def path(self, ref):
+        return os.path.join(self.directory, hashlib.sha256(ref.encode()).hexdigest()[:32])
+
+    def get(self, ref):
+        """Returns (path, meta) for ref, fetching the photo when it is not on disk. Upstream errors propagate."""
+        path = self.path(ref)
+        meta = self.index.get(ref)
+        if meta is not None:
+            try:
+                os.utime(path)
+                return path, meta
+            except FileNotFoundError:
+                pass  # Pruned, possibly by another worker.
+        return path, self._inflight.do(ref, lambda: self._fetch(ref, path))
+
+    def _fetch(self, ref, path):
+        params = {'maxwidth': PHOTO_WIDTH, 'photoreference': ref, 'key': GOOGLE_MAPS_API_KEY}
+        response = upstream_call("photo", lambda: http.get(f"{GOOGLE_MAPS_BASE_URL}/maps/api/place/photo", params=params, timeout=HTTP_TIMEOUT)); response.raise_for_status()
+        mimetype = response.headers.get('Content-Type', 'image/jpeg').split(';')[0].strip()
+        if not mimetype.startswith('image/'):
+            raise ValueError(f"Photo endpoint returned {mimetype}")
+        data, mimetype = shrink_photo(response.content, mimetype)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f: f.write(data)
+        os.replace(tmp_path, path)
+        meta = {'etag': hashlib.sha256(data).hexdigest()[:32], 'mimetype': mimetype, 'size': len(data)}
+        self.index.set(ref, meta)
+        self._writes += 1
+        if self._writes % self.PRUNE_EVERY == 0: background_pool.submit(self.prune)
+        return meta
+
+    def prune(self):
+        try:
+            stats = [(e.path, e.stat()) for e in os.scandir(self.directory) if e.is_file() and not e.name.endswith('.tmp')]
+            files = [(st.st_mtime, st.st_size, path) for path, st in stats]
+            total = sum(size for _, size, _ in files)
+            for _, size, path in sorted(files):
+                if total <= self.max_bytes: break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+        except OSError as e:
+            logger.warning("Photo cache prune failed: %s", e)
+
+photo_cache = PhotoCache(PHOTO_CACHE_DIR, PHOTO_CACHE_MAX_BYTES)
 
 # --- Flask Routes ---
 @app.route("/")
 def home():
-    session.clear()
+    end_session()
     return render_template("index.html")
 
 @app.route("/refine", methods=["POST"])
 def refine_page():
-    session.clear()
+    end_session()
     plan_id = request.form.get("plan_id")
     if plan_id and plan_id in plan_book:
         return render_template("refine.html", plan_id=plan_id, plan=plan_book[plan_id])
@@ -274,7 +1464,7 @@ def refine_page():
 
 @app.route("/app", methods=["POST"])
 def app_page():
-    session.clear()
+    end_session()
     form_data = request.form
 
     if 'query' in form_data and form_data.get('query'):
@@ -288,112 +1478,237 @@ def app_page():
         if not plan:
             return redirect(url_for('home'))
 
-        initial_prompt = [plan['base_prompt']]
         session['display_title'] = plan['display_title']
-        
-        if form_data.get('action') == 'get_recommendations':
-            for question in plan['questions']:
-                q_id = question['id']
-                if q_id in form_data and form_data[q_id]:
-                    initial_prompt.append(f"For '{question['text']}', the user specified '{form_data[q_id]}'.")
-        
-        session['initial_query'] = " ".join(initial_prompt)
+        session['initial_query'] = build_plan_query(plan, form_data, form_data.get('action'))
         return render_template("app.html")
     
     return redirect(url_for('home'))
 
 
-@app.route("/get_recommendation", methods=["POST"])
-def get_recommendation_route():
+def candidate_summary(place):
+    return {'place_id': place['place_id'], 'name': place.get('name'), 'vicinity': place.get('vicinity'),
+            'rating': place.get('rating'), 'user_ratings_total': place.get('user_ratings_total')}
+
+def recommendation_events(data, streaming=False):
+    """Runs the recommendation pipeline, yielding (event, payload) as each stage finishes.
+
+    The last event is always ("result", (body, status)), the response of the JSON endpoint. With
+    streaming=True the ranking LLM output is streamed as "ranking" progress events. Work that should
+    start once the response is sent is left in g.after_response.
+    """
     try:
-        print("[DEBUG] Incoming /get_recommendation request")
-        data = request.json
-        print(f"[DEBUG] Request data: {data}")
-        print(f"[DEBUG] Session before processing: {dict(session)}")
+        g.sample_payloads = logger.isEnabledFor(logging.DEBUG) and random.random() < DEBUG_SAMPLE_RATE
+        logger.debug("Recommendation request, session %s", session_summary())
+        log_payload("Request data", lambda: data)
         location = data.get("location")
         user_input = data.get("query")
         is_feedback = data.get("is_feedback", False)
         
         # Defensive check for user_input
         if not user_input or not isinstance(user_input, str) or not user_input.strip():
-            print("[DEBUG] user_input is missing or empty.")
-            return jsonify({"type": "error", "content": "No user input provided."})
-
-        if 'conversation' not in session:
-            if not moderate_query(user_input): 
-                print("[DEBUG] Query flagged as inappropriate by moderation.")
-                return jsonify({"type": "error", "content": "This search is not permitted."})
-            session['conversation'] = f"User's initial request: {user_input}"
-            session['excluded_ids'] = []
-            session['retries'] = 0
+            logger.debug("user_input is missing or empty.")
+            yield "result", ({"type": "error", "content": "No user input provided."}, 200); return
+
+        is_first_turn = 'conversation' not in session
+        if is_first_turn:
+            conversation = f"User's initial request: {user_input}"
+        elif is_feedback:
+            if session.get('retries', 0) >= 2: 
+                logger.debug("Retry limit reached for feedback.")
+                yield "result", ({"type": "final_message", "content": "I've tried my best. Let's start a new search!"}, 200); return
+            conversation = session['conversation'] + f"\nUser was not satisfied. New request: {user_input}"
         else:
-            if is_feedback:
-                if not moderate_query(user_input): 
-                    print("[DEBUG] Feedback query flagged as inappropriate by moderation.")
-                    return jsonify({"type": "error", "content": "This search is not permitted."})
-                if session.get('retries', 0) >= 2: 
-                    print("[DEBUG] Retry limit reached for feedback.")
-                    return jsonify({"type": "final_message", "content": "I've tried my best. Let's start a new search!"})
-                session['retries'] += 1
-                session['conversation'] += f"\nUser was not satisfied. New request: {user_input}"
-            else:
-                 session['conversation'] += f"\nMy Answer: {user_input}"
+            conversation = session['conversation'] + f"\nMy Answer: {user_input}"
+
+        # Moderation runs alongside refinement; the refined keyword is discarded if the query is refused.
+        needs_moderation = is_first_turn or is_feedback
+        refused = needs_moderation and prefilter_moderation(user_input) is False
+        moderation = fetch_pool.submit(moderate_query, user_input) if needs_moderation and not refused else None
+        llm_response = refine_conversation(conversation, user_input if is_first_turn else None) if not refused else None
+        if refused or (moderation is not None and not moderation.result()):
+            logger.info("Query refused by moderation.")
+            yield "result", ({"type": "error", "content": "This search is not permitted."}, 200); return
+
+        session['conversation'] = conversation
+        if is_first_turn:
+            session['excluded_ids'] = set()
+            session['retries'] = 0
+        elif is_feedback:
+            session['retries'] += 1
 
         if data.get("distance"):
             session['travel_distance'] = int(data.get("distance"))
         if data.get('expand_search'):
             session['travel_distance'] = 20000
 
-        print(f"[DEBUG] Session after input processing: {dict(session)}")
-        llm_response = refine_query_with_llm(session['conversation'])
-        print(f"[DEBUG] LLM response: {llm_response}")
+        logger.debug("Refined to %s, session %s", llm_response, session_summary())
         if llm_response.get("type") != "keyword":
-            print("[DEBUG] LLM did not return a keyword, returning response.")
-            return jsonify(llm_response)
+            logger.debug("LLM did not return a keyword, returning response.")
+            yield "result", (llm_response, 200); return
 
         final_keyword = llm_response.get("content")
         session['last_keyword'] = final_keyword
+        yield "keyword", {"keyword": final_keyword}
         
         current_distance = session.get('travel_distance', 3000)
-        print(f"[DEBUG] Calling get_nearby_places with location={location}, keyword={final_keyword}, distance={current_distance}")
-        nearby_places = get_nearby_places(location, final_keyword, current_distance)
-        print(f"[DEBUG] Nearby places: {nearby_places}")
-
-        if not nearby_places or not nearby_places.get('results'):
-            if current_distance < 20000:
-                print("[DEBUG] No places found, suggesting to expand search.")
-                return jsonify({"type": "expand_search", "message": "I couldn't find anything in that range. Would you like to expand the search area?"})
-            else:
-                print("[DEBUG] No places found even after expanding search.")
-                return jsonify({"type": "error", "content": "I couldn't find any places, even in a wider area."})
-
-        unseen_places = [p for p in nearby_places['results'] if p.get('place_id') not in session.get('excluded_ids', [])]
-        print(f"[DEBUG] Unseen places: {unseen_places}")
-        
-        if not unseen_places:
-            print("[DEBUG] No unseen places found.")
-            return jsonify({"type": "error", "content": "I couldn't find any new places matching your refined search. Try broadening your criteria or starting a new search."})
-        
-        detailed_places = [get_place_details_and_photos(p.get('place_id')) for p in unseen_places[:10] if p.get('place_id')]
-        print(f"[DEBUG] Detailed places: {detailed_places}")
-        final_recs_data = get_final_recommendation(session['conversation'], [d for d in detailed_places if d], location)
-        print(f"[DEBUG] Final recommendations data: {final_recs_data}")
+        excluded_ids = session.get('excluded_ids', set())
+        pool = get_candidate_pool(session.sid, final_keyword, location, current_distance)
+        pooled_places, pooled_travel_times = pool.ready(excluded_ids) if pool else ([], {})
+        nearby_places = None
+        if len(pooled_places) >= PREFETCH_MIN_READY:
+            metrics.inc("locale_candidate_pool_total", result="hit")
+            logger.debug("Ranking %d prefetched candidates", len(pooled_places))
+            detailed_places, travel_times_map = pooled_places[:10], pooled_travel_times
+            yield "candidates", {"places": [candidate_summary(p) for p in detailed_places]}
+            yield "travel_times", {"travel_times": travel_times_map}
+        else:
+            metrics.inc("locale_candidate_pool_total", result="too_few" if pool else "miss")
+            nearby_places = get_nearby_places(location, final_keyword, current_distance)
+            log_payload("Nearby places", lambda: nearby_places)
+
+            if not nearby_places or not nearby_places.get('results'):
+                if current_distance < 20000:
+                    logger.debug("No places found, suggesting to expand search.")
+                    yield "result", ({"type": "expand_search", "message": "I couldn't find anything in that range. Would you like to expand the search area?"}, 200); return
+                else:
+                    logger.debug("No places found even after expanding search.")
+                    yield "result", ({"type": "error", "content": "I couldn't find any places, even in a wider area."}, 200); return
+
+            unseen_places = [p for p in nearby_places['results'] if p.get('place_id') not in excluded_ids]
+            
+            if not unseen_places:
+                logger.debug("No unseen places found.")
+                yield "result", ({"type": "error", "content": "I couldn't find any new places matching your refined search. Try broadening your criteria or starting a new search."}, 200); return
+            
+            # Details and travel times only need the Nearby Search results, so both run in one round-trip.
+            candidates = [p for p in unseen_places[:10] if p.get('place_id')]
+            candidate_ids = [p['place_id'] for p in candidates]
+            travel_times_future = fetch_pool.submit(get_travel_times, location, candidates)
+            details_future = fetch_pool.submit(fetch_place_details, candidate_ids)
+            yield "candidates", {"places": [candidate_summary(p) for p in candidates]}
+            try:
+                travel_times_map = travel_times_future.result(timeout=FETCH_STAGE_TIMEOUT)
+            except Exception as e:
+                logger.warning("Travel times unavailable: %s", e); travel_times_map = {}
+            yield "travel_times", {"travel_times": travel_times_map}
+            try:
+                detailed_places = details_future.result(timeout=FETCH_STAGE_TIMEOUT)
+            except Exception as e:
+                logger.warning("Place details unavailable: %s", e); detailed_places = []
+            log_payload("Detailed places", lambda: detailed_places)
+
+        if streaming:
+            progress, disconnected = queue.Queue(), threading.Event()
+            def report(update):
+                if disconnected.is_set(): raise RankingAbandoned()
+                progress.put(update)
+            ranking_future = fetch_pool.submit(get_final_recommendation, session['conversation'], detailed_places, location, travel_times_map, report)
+            try:
+                while not ranking_future.done() or not progress.empty():
+                    try:
+                        yield "ranking", progress.get(timeout=0.1)
+                    except queue.Empty:
+                        pass
+            except GeneratorExit:
+                # The client went away: drop the ranking if it has not started, else stop reading its stream.
+                disconnected.set(); ranking_future.cancel()
+                metrics.inc("locale_stream_disconnects_total")
+                raise
+            final_recs_data = ranking_future.result()
+        else:
+            final_recs_data = get_final_recommendation(session['conversation'], detailed_places, location, travel_times_map)
+        log_payload("Final recommendations", lambda: final_recs_data)
 
         if not final_recs_data or not final_recs_data.get("recommendations"):
-            print("[DEBUG] AI had trouble picking final recommendations.")
-            return jsonify({"type": "error", "content": "The AI had trouble picking final recommendations. Please try again."})
+            logger.warning("Ranking returned no recommendations.")
+            yield "result", ({"type": "error", "content": "The AI had trouble picking final recommendations. Please try again."}, 200); return
 
-        session['excluded_ids'].extend([p.get('place_id') for p in detailed_places if p])
+        session['excluded_ids'].update(p.get('place_id') for p in final_recs_data['recommendations'])
         final_recs_data['last_keyword'] = final_keyword
+        if nearby_places is not None:
+            g.after_response = partial(start_prefetch, session.sid, final_keyword, location, current_distance, nearby_places,
+                                       set(session['excluded_ids']), detailed_places, travel_times_map)
         
         session.modified = True
-        print(f"[DEBUG] Session before response: {dict(session)}")
-        return jsonify({"type": "recommendation", "data": final_recs_data})
+        logger.debug("Responding with %d recommendations, session %s", len(final_recs_data['recommendations']), session_summary())
+        yield "result", ({"type": "recommendation", "data": final_recs_data}, 200)
+    except Exception:
+        logger.exception("Exception in /get_recommendation")
+        yield "result", ({"type": "error", "content": "An internal server error occurred. Please try again later."}, 500)
+
+@app.route("/get_recommendation", methods=["POST"])
+def get_recommendation_route():
+    started = time.monotonic()
+    for event, payload in recommendation_events(request.json or {}):
+        if event == "result":
+            body, status = payload
+    metrics.observe("locale_request_seconds", time.monotonic() - started, endpoint="json", result=body.get("type"))
+    response = jsonify(body)
+    if g.get('after_response'): response.call_on_close(g.after_response)
+    return response, status
+
+@app.route("/get_recommendation/stream", methods=["POST"])
+def get_recommendation_stream_route():
+    """Server-Sent Events: keyword, candidates, travel_times and ranking progress, then the JSON endpoint's body as "result"."""
+    started = time.monotonic()
+    events = recommendation_events(request.json or {}, streaming=True)
+    # Run up to the keyword so a brand-new session already has content when its cookie is set.
+    head = []
+    for event in events:
+        head.append(event)
+        if event[0] in ("keyword", "result"): break
+    metrics.observe("locale_stream_first_event_seconds", time.monotonic() - started)
+    def stream():
+        try:
+            for event, payload in itertools.chain(head, events):
+                if event == "result":
+                    payload = payload[0]
+                    metrics.observe("locale_request_seconds", time.monotonic() - started, endpoint="stream", result=payload.get("type"))
+                yield f"event: {event}\ndata: {json.dumps(payload, separators=(',', ':'))}\n\n"
+        except GeneratorExit:
+            events.close(); raise
+        if session.modified: app.session_interface.persist(session)
+        if g.get('after_response'): g.after_response()
+    return Response(stream_with_context(stream()), mimetype="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@app.route("/metrics")
+def metrics_route():
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+@app.route("/photo/<ref>")
+def photo_route(ref):
+    """Serves a place photo from the proxy cache. The content never changes for a reference, so browsers and CDNs may keep it."""
+    if not PHOTO_REF_PATTERN.fullmatch(ref) or not hmac.compare_digest(request.args.get('sig', ''), sign_photo_ref(ref)):
+        metrics.inc("locale_photo_rejected_total")
+        return "Unknown photo", 404
+    try:
+        path, meta = photo_cache.get(ref)
+        # send_file hands the open file to the server's wsgi.file_wrapper, which gunicorn serves with sendfile().
+        response = send_file(path, mimetype=meta['mimetype'], etag=meta['etag'], max_age=PHOTO_MAX_AGE, conditional=True)
     except Exception as e:
-        import traceback
-        print(f"[ERROR] Exception in /get_recommendation: {e}")
-        traceback.print_exc()
-        return jsonify({"type": "error", "content": "An internal server error occurred. Please try again later."}), 500
+        logger.warning("Photo %s unavailable: %s", ref, e); return "Photo unavailable", 502
+    response.cache_control.immutable = True
+    return response
+
+@app.route("/cache_stats")
+def cache_stats():
+    return jsonify({"place_details": place_details_cache.snapshot(), "nearby_search": nearby_cache.snapshot(),
+                    "nearby_search_page2": nearby_page2_cache.snapshot(), "moderation": moderation_cache.snapshot(),
+                    "distance_matrix": travel_time_cache.snapshot(), "photos": photo_cache.index.snapshot()})
+
+@app.cli.command("build-keyword-table")
+def build_keyword_table():
+    """Refines every plan query that is missing from the keyword table."""
+    missing = sorted(q for q in keyword_table.queries if not keyword_table.lookup(q))
+    print(f"{len(keyword_table.queries)} plan queries, {len(missing)} to refine.")
+    futures = {fetch_pool.submit(refine_query_with_llm, f"User's initial request: {q}"): q for q in missing}
+    for future, query in futures.items():
+        llm_response = future.result()
+        if llm_response.get("type") == "keyword":
+            keyword_table.add(query, llm_response["content"])
+        else:
+            print(f"No keyword for: {query}")
+    print(f"Keyword table {keyword_table.version} has {len(keyword_table.keywords)} entries.")
 
 @app.route("/history")
 def history_page():
@@ -0,0 +1,162 @@
+"""Drives recommendation conversations against a running app and reports latency percentiles.
+
+Each virtual user posts to /app (a free-text query or a plan), asks for recommendations, answers a
+clarifying question or accepts an expand_search offer when the app asks, then sends one piece of
+"not satisfied" feedback. Turns use /get_recommendation/stream by default, so the arrival time of
+each Server-Sent Event gives per-stage latencies; --json uses the plain JSON endpoint instead.
+
+    python -m bench.loadgen --app http://127.0.0.1:8000 --stub http://127.0.0.1:8099 --concurrency 16 --conversations 200
+"""
+import argparse
+import html
+import json
+import random
+import sys
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+FREE_TEXT_QUERIES = ["cozy date spot", "quiet cafe to work", "cheap tacos", "rooftop bar with a view", "family friendly pizza",
+                     "sushi for a birthday", "a speakeasy with live jazz", "vegan brunch"]
+PLAN_FORMS = [
+    {"plan_id": "date_night", "action": "get_recommendations", "vibe": "cozy_romantic", "budget": "nice_treat", "cuisine": ""},
+    {"plan_id": "client_dinner", "action": "get_recommendations", "formality": "formal_dining", "cuisine": ""},
+    {"plan_id": "coffee_focus", "action": "get_recommendations", "primary_goal": "get_work_done", "noise_level": "quiet"},
+    {"plan_id": "hidden_gem", "action": "surprise_me"},
+]
+FEEDBACK = ["something cheaper", "somewhere quieter", "with outdoor seating", "closer to me"]
+# Stream events and the stage that finished when each one arrived.
+STAGE_EVENTS = {"keyword": "moderation_refinement", "candidates": "nearby_search", "travel_times": "travel_times", "result": "details_ranking"}
+
+
+def percentile(values, pct):
+    if not values: return None
+    ordered = sorted(values)
+    return round(ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))] * 1000, 1)
+
+
+def summarize(values):
+    return {"count": len(values), "p50_ms": percentile(values, 50), "p95_ms": percentile(values, 95), "p99_ms": percentile(values, 99)}
+
+
+class Recorder:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.turns = defaultdict(list)
+        self.stages = defaultdict(list)
+        self.results = defaultdict(int)
+        self.failures = 0
+
+    def record(self, turn, elapsed, result_type, stages):
+        with self.lock:
+            self.turns[turn].append(elapsed)
+            self.turns["all"].append(elapsed)
+            self.results[result_type] += 1
+            for stage, seconds in stages.items(): self.stages[stage].append(seconds)
+
+    def fail(self):
+        with self.lock: self.failures += 1
+
+
+def post_turn(http, app_url, body, use_stream, timeout):
+    """Sends one turn. Returns the final response body and the seconds each stage took."""
+    started = time.monotonic()
+    if not use_stream:
+        response = http.post(f"{app_url}/get_recommendation", json=body, timeout=timeout)
+        return response.json(), {}
+    stages, last, event, result = {}, started, None, None
+    with http.post(f"{app_url}/get_recommendation/stream", json=body, stream=True, timeout=timeout) as response:
+        for line in response.iter_lines(decode_unicode=True):
+            if line.startswith("event: "):
+                event = line[7:]
+            elif line.startswith("data: ") and event in STAGE_EVENTS:
+                now = time.monotonic()
+                stages[STAGE_EVENTS[event]] = now - last
+                last = now
+                if event == "result": result = json.loads(line[6:])
+    return result, stages
+
+
+def run_conversation(app_url, rng, recorder, use_stream, timeout):
+    http = requests.Session()
+    location = {"lat": 40.7128 + rng.uniform(-0.05, 0.05), "lng": -74.0060 + rng.uniform(-0.05, 0.05)}
+    if rng.random() < 0.5:
+        query = rng.choice(FREE_TEXT_QUERIES)
+        http.post(f"{app_url}/app", data={"query": query}, timeout=timeout)
+    else:
+        form = rng.choice(PLAN_FORMS)
+        page = http.post(f"{app_url}/app", data=form, timeout=timeout).text
+        query = html.unescape(page.split('id="initial-query" value="', 1)[1].split('"', 1)[0])
+    turns = [("initial", {"query": query, "location": location, "distance": rng.choice(["1500", "4000", "8000"]), "is_feedback": False})]
+    while turns:
+        turn, body = turns.pop(0)
+        started = time.monotonic()
+        try:
+            result, stages = post_turn(http, app_url, body, use_stream, timeout)
+        except (requests.RequestException, ValueError):
+            recorder.fail(); return
+        result_type = (result or {}).get("type", "no_result")
+        # Stage timings only mean something for turns that ran the whole pipeline.
+        recorder.record(turn, time.monotonic() - started, result_type, stages if result_type == "recommendation" else {})
+        if result_type == "question" and turn != "answer":
+            turns.append(("answer", {"query": "italian", "location": location, "is_feedback": False}))
+        elif result_type == "expand_search" and turn != "expand_search":
+            turns.append(("expand_search", {"query": query, "location": location, "is_feedback": False, "expand_search": True}))
+        elif result_type == "recommendation" and turn != "feedback":
+            turns.append(("feedback", {"query": rng.choice(FEEDBACK), "location": location, "is_feedback": True}))
+
+
+def stub_stats(stub_url):
+    return requests.get(f"{stub_url}/__stats", timeout=5).json() if stub_url else {"calls": {}, "throttled": {}}
+
+
+def run(app_url, stub_url=None, concurrency=8, conversations=100, use_stream=True, seed=0, timeout=60, workers=1):
+    recorder = Recorder()
+    before = stub_stats(stub_url)
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        futures = [pool.submit(run_conversation, app_url, random.Random(seed + i), recorder, use_stream, timeout) for i in range(conversations)]
+    elapsed = time.monotonic() - started
+    # A virtual user that crashed counts as a failed conversation rather than vanishing from the report.
+    crashed = [f.exception() for f in futures if f.exception() is not None]
+    for error in crashed:
+        print(f"Virtual user crashed: {error!r}", file=sys.stderr)
+        recorder.fail()
+    after = stub_stats(stub_url)
+    turns = len(recorder.turns["all"])
+    report = {
+        "config": {"concurrency": concurrency, "conversations": conversations, "stream": use_stream, "seed": seed, "workers": workers},
+        "elapsed_s": round(elapsed, 2),
+        "requests": turns,
+        "failures": recorder.failures,
+        "requests_per_s": round(turns / elapsed, 2) if elapsed else None,
+        "requests_per_s_per_worker": round(turns / elapsed / workers, 2) if elapsed else None,
+        "end_to_end": {turn: summarize(values) for turn, values in recorder.turns.items()},
+        "stages": {stage: summarize(values) for stage, values in recorder.stages.items()},
+        "result_types": dict(recorder.results),
+        "upstream_calls": {name: count - before["calls"].get(name, 0) for name, count in after["calls"].items()},
+        "upstream_throttled": {name: count - before.get("throttled", {}).get(name, 0) for name, count in after.get("throttled", {}).items()},
+    }
+    report["upstream_calls_per_request"] = {name: round(count / turns, 2) for name, count in report["upstream_calls"].items()} if turns else {}
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--app", default="http://127.0.0.1:8000")
+    parser.add_argument("--stub", help="Stand-in server URL, for upstream call counts")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--conversations", type=int, default=100)
+    parser.add_argument("--workers", type=int, default=1, help="gunicorn workers serving --app, for requests/s per worker")
+    parser.add_argument("--json", action="store_true", help="Use /get_recommendation instead of the streaming endpoint")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    report = run(args.app, args.stub, args.concurrency, args.conversations, not args.json, args.seed, workers=args.workers)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
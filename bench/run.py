@@ -0,0 +1,103 @@
+"""Starts the stand-in upstreams and gunicorn, runs the load generator and saves the report.
+
+    python -m bench.run --workers 2 --concurrency 16 --conversations 200
+    python -m bench.run --profile bench/profiles/flaky.json --compare bench/results/<earlier>.json
+
+Reports are written to bench/results/ with a timestamp. --compare prints the change in the main
+latency and throughput figures against an earlier report.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+
+from bench import loadgen
+from bench.stub_server import load_profile, serve
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(ROOT, "bench", "results")
+
+
+def wait_until_up(url, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            requests.get(url, timeout=1); return
+        except requests.RequestException:
+            time.sleep(0.2)
+    raise RuntimeError(f"{url} did not come up within {timeout}s")
+
+
+def start_app(port, stub_url, workers, worker_class, state_dir, extra_env):
+    env = {**os.environ, "GOOGLE_MAPS_API_KEY": "bench", "OPENAI_API_KEY": "bench",
+           "GOOGLE_MAPS_BASE_URL": stub_url, "OPENAI_BASE_URL": f"{stub_url}/v1",
+           "CACHE_DB_PATH": os.path.join(state_dir, "cache.sqlite3"), "KEYWORD_TABLE_PATH": os.path.join(state_dir, "keyword_table.json"),
+           "PHOTO_CACHE_DIR": os.path.join(state_dir, "photos"),
+           "SESSION_BACKEND": "sqlite", "SECRET_KEY": "bench", **extra_env}
+    command = [sys.executable, "-m", "gunicorn", "app:app", "--bind", f"127.0.0.1:{port}", "--workers", str(workers),
+               "--worker-class", worker_class, "--log-level", "warning"]
+    return subprocess.Popen(command, cwd=ROOT, env=env, stdout=subprocess.DEVNULL)
+
+
+def compare(report, baseline):
+    """Relative change of the headline numbers, e.g. {"end_to_end.all.p95_ms": "+4.2%"}."""
+    changes = {}
+    def diff(path, new, old):
+        if isinstance(new, (int, float)) and isinstance(old, (int, float)) and old:
+            changes[path] = f"{(new - old) / old * 100:+.1f}%"
+    diff("requests_per_s_per_worker", report["requests_per_s_per_worker"], baseline.get("requests_per_s_per_worker"))
+    for section in ("end_to_end", "stages"):
+        for name, stats in report[section].items():
+            for pct in ("p50_ms", "p95_ms", "p99_ms"):
+                diff(f"{section}.{name}.{pct}", stats[pct], baseline.get(section, {}).get(name, {}).get(pct))
+    for name, count in report["upstream_calls_per_request"].items():
+        diff(f"upstream_calls_per_request.{name}", count, baseline.get("upstream_calls_per_request", {}).get(name))
+    return changes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--profile", help="Stand-in latency/error profile (see bench/profiles)")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--worker-class", default="gevent", help="gunicorn worker class; gevent matches the Procfile")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--conversations", type=int, default=100)
+    parser.add_argument("--json", action="store_true", help="Use /get_recommendation instead of the streaming endpoint")
+    parser.add_argument("--app-port", type=int, default=8098)
+    parser.add_argument("--stub-port", type=int, default=8099)
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE", help="Extra environment for the app")
+    parser.add_argument("--label", default="", help="Appended to the report file name")
+    parser.add_argument("--compare", help="Earlier report to compare against")
+    args = parser.parse_args()
+
+    stub = serve(args.stub_port, load_profile(args.profile))
+    stub_url = f"http://127.0.0.1:{args.stub_port}"
+    threading.Thread(target=stub.serve_forever, daemon=True).start()
+    app_url = f"http://127.0.0.1:{args.app_port}"
+    with tempfile.TemporaryDirectory() as state_dir:
+        app = start_app(args.app_port, stub_url, args.workers, args.worker_class, state_dir, dict(e.split("=", 1) for e in args.env))
+        try:
+            wait_until_up(app_url)
+            report = loadgen.run(app_url, stub_url, args.concurrency, args.conversations, not args.json, workers=args.workers)
+        finally:
+            app.terminate(); app.wait(timeout=30)
+            stub.shutdown()
+    report["config"].update({"profile": args.profile, "worker_class": args.worker_class, "env": args.env})
+
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    path = os.path.join(RESULTS_DIR, time.strftime("%Y%m%d-%H%M%S") + (f"-{args.label}" if args.label else "") + ".json")
+    with open(path, "w") as f: json.dump(report, f, indent=2)
+    print(json.dumps(report, indent=2))
+    print(f"Saved {path}")
+    if args.compare:
+        with open(args.compare) as f: print(json.dumps(compare(report, json.load(f)), indent=2))
+
+
+if __name__ == "__main__":
+    main()
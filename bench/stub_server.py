@@ -0,0 +1,255 @@
+"""Local stand-in for the Google Maps and OpenAI endpoints that app.py calls.
+
+Each endpoint sleeps for a latency drawn from a log-normal distribution, fails at a configurable rate
+and answers with canned, deterministic payloads, so load tests cost no API quota. An endpoint with
+"rate_limit_per_s" answers calls over that rate the way the real API does when a quota is exceeded
+(OVER_QUERY_LIMIT for Google, 429 for OpenAI):
+
+    python -m bench.stub_server --port 8099 --profile bench/profiles/fast.json
+
+Point the app at it with GOOGLE_MAPS_BASE_URL=http://127.0.0.1:8099 and
+OPENAI_BASE_URL=http://127.0.0.1:8099/v1. GET /__stats returns call counts per endpoint and
+POST /__stats/reset clears them.
+"""
+import argparse
+import hashlib
+import json
+import math
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+DEFAULT_PROFILE = {
+    "nearby": {"median_ms": 150, "sigma": 0.35, "error_rate": 0.0, "zero_results_rate": 0.02, "results": 20},
+    "details": {"median_ms": 120, "sigma": 0.35, "error_rate": 0.0},
+    "distance_matrix": {"median_ms": 160, "sigma": 0.35, "error_rate": 0.0},
+    "photo": {"median_ms": 80, "sigma": 0.3, "error_rate": 0.0},
+    "moderation": {"median_ms": 400, "sigma": 0.4, "error_rate": 0.0},
+    "refine": {"median_ms": 700, "sigma": 0.4, "error_rate": 0.0, "question_rate": 0.1},
+    "ranking": {"median_ms": 2500, "sigma": 0.35, "error_rate": 0.0},
+}
+# A 1x1 PNG, enough for the photo endpoint.
+PHOTO_BYTES = bytes.fromhex("89504e470d0a1a0a0000000d4948445200000001000000010806000000"
+                            "1f15c4890000000d49444154789c6360f8ffff3f0005fe02fea7d6a4"
+                            "e60000000049454e44ae426082")
+REVIEW_SENTENCES = [
+    "Cozy and romantic spot with dim lighting.", "Great for a quiet conversation.", "The wine list is excellent.",
+    "Service was friendly and quick.", "It gets loud and lively on weekends.", "Perfect place to get some work done.",
+    "Kids loved the menu and the staff were patient.", "A real hidden gem that only locals know about.",
+    "Prices are reasonable for the quality.", "Upscale feel without being stuffy.",
+]
+
+
+class StubState:
+    def __init__(self, profile, seed):
+        self.profile = profile
+        self.random = random.Random(seed)
+        self.counts = {name: 0 for name in profile}
+        self.errors = {name: 0 for name in profile}
+        self.throttled = {name: 0 for name in profile}
+        self.recent = {name: [] for name in profile}
+        self.lock = threading.Lock()
+
+    def over_quota(self, endpoint):
+        """True if the call goes over the endpoint's rate_limit_per_s, counted over the last second."""
+        limit = self.profile[endpoint].get("rate_limit_per_s")
+        if not limit: return False
+        now = time.monotonic()
+        recent = self.recent[endpoint] = [t for t in self.recent[endpoint] if now - t < 1]
+        if len(recent) >= limit: return True
+        recent.append(now)
+        return False
+
+    def begin(self, endpoint):
+        """Counts the call, sleeps for its latency and returns "throttled", "error" or None."""
+        config = self.profile[endpoint]
+        with self.lock:
+            self.counts[endpoint] += 1
+            if self.over_quota(endpoint):
+                self.throttled[endpoint] += 1
+                return "throttled"
+            latency = config["median_ms"] * math.exp(self.random.gauss(0, config.get("sigma", 0)))
+            failed = self.random.random() < config.get("error_rate", 0)
+            if failed: self.errors[endpoint] += 1
+        time.sleep(latency / 1000)
+        return "error" if failed else None
+
+    def chance(self, rate):
+        with self.lock: return self.random.random() < rate
+
+    def snapshot(self):
+        with self.lock: return {"calls": dict(self.counts), "errors": dict(self.errors), "throttled": dict(self.throttled)}
+
+    def reset(self):
+        with self.lock:
+            self.counts = {name: 0 for name in self.profile}
+            self.errors = {name: 0 for name in self.profile}
+            self.throttled = {name: 0 for name in self.profile}
+
+
+def stable_int(*parts):
+    return int(hashlib.sha256("|".join(map(str, parts)).encode()).hexdigest()[:8], 16)
+
+
+def nearby_payload(location, keyword, radius, count, page=0):
+    lat, lng = (float(x) for x in location.split(","))
+    seed = stable_int(keyword, round(lat, 2), round(lng, 2), page)
+    results = []
+    for i in range(count):
+        h = stable_int(seed, i)
+        # Spread results over the search circle.
+        distance = radius * ((h % 1000) / 1000) ** 0.5
+        angle = (h // 1000 % 360) * math.pi / 180
+        results.append({
+            "place_id": f"stub_{seed:x}_{page}_{i}", "name": f"Stub Place {seed % 997}-{page}-{i}",
+            "geometry": {"location": {"lat": lat + distance * math.cos(angle) / 111320,
+                                      "lng": lng + distance * math.sin(angle) / (111320 * math.cos(math.radians(lat)))}},
+            "rating": round(3.5 + (h % 15) / 10, 1), "user_ratings_total": 10 + h % 2000, "vicinity": f"{h % 900 + 1} Stub Street",
+        })
+    payload = {"status": "OK", "results": results}
+    if page == 0: payload["next_page_token"] = f"{seed:x}:{location}:{radius}:{keyword}"
+    return payload
+
+
+def details_payload(place_id):
+    h = stable_int(place_id)
+    reviews = [{"text": " ".join(REVIEW_SENTENCES[(h + i + j) % len(REVIEW_SENTENCES)] for j in range(3))} for i in range(5)]
+    return {"status": "OK", "result": {
+        "place_id": place_id, "name": f"Stub Place {h % 997}", "rating": round(3.5 + (h % 15) / 10, 1),
+        "user_ratings_total": 10 + h % 2000, "price_level": h % 4 + 1, "types": ["restaurant", "food", "point_of_interest"],
+        "editorial_summary": {"overview": REVIEW_SENTENCES[h % len(REVIEW_SENTENCES)]}, "wheelchair_accessible_entrance": bool(h % 2),
+        "reviews": reviews, "photos": [{"photo_reference": f"stubphoto_{place_id}_{i}"} for i in range(3)],
+    }}
+
+
+def matrix_payload(destinations):
+    elements = []
+    for destination in destinations.split("|"):
+        seconds = 120 + stable_int(destination) % 2400
+        elements.append({"status": "OK", "duration": {"value": seconds, "text": f"{max(1, seconds // 60)} mins"}})
+    return {"status": "OK", "rows": [{"elements": elements}]}
+
+
+def chat_content(state, messages):
+    system, user = messages[0]["content"], messages[-1]["content"]
+    if "moderator" in system:
+        return "moderation", "safe"
+    if "query refiner" in system:
+        if state.chance(state.profile["refine"].get("question_rate", 0)) and "My Answer" not in user:
+            return "refine", json.dumps({"type": "question", "content": "What type of food are you in the mood for?"})
+        words = re.findall(r"[a-z]+", user.lower())
+        return "refine", json.dumps({"type": "keyword", "content": " ".join(sorted(set(w for w in words if len(w) > 4))[:5]) or "restaurant"})
+    place_ids = list(dict.fromkeys(re.findall(r'"place_id":\s*"([^"]+)"', user)))
+    return "ranking", json.dumps({"ranked_recommendations": [
+        {"place_id": pid, "relevance_score": 5 + stable_int(pid, "r") % 6, "vibe_score": 5 + stable_int(pid, "v") % 6,
+         "justification": "A stand-in justification long enough to look like the real thing for payload sizing."}
+        for pid in place_ids]})
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    state = None
+
+    def log_message(self, *args):
+        pass
+
+    def send_json(self, payload, status=200):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = {k: v[0] for k, v in parse_qs(url.query).items()}
+        if url.path == "/__stats":
+            return self.send_json(self.state.snapshot())
+        endpoint = {"/maps/api/place/nearbysearch/json": "nearby", "/maps/api/place/details/json": "details",
+                    "/maps/api/distancematrix/json": "distance_matrix", "/maps/api/place/photo": "photo"}.get(url.path)
+        if endpoint is None:
+            return self.send_json({"error": "unknown endpoint"}, 404)
+        outcome = self.state.begin(endpoint)
+        if outcome == "throttled":
+            return self.send_json({"status": "OVER_QUERY_LIMIT", "results": []}) if endpoint != "photo" else self.send_json({}, 429)
+        if outcome == "error":
+            return self.send_json({"status": "UNKNOWN_ERROR"}, 500)
+        if endpoint == "nearby":
+            config = self.state.profile["nearby"]
+            if "pagetoken" in params:
+                _, location, radius, keyword = params["pagetoken"].split(":", 3)
+                return self.send_json(nearby_payload(location, keyword, float(radius), config["results"], page=1))
+            if self.state.chance(config.get("zero_results_rate", 0)):
+                return self.send_json({"status": "ZERO_RESULTS", "results": []})
+            return self.send_json(nearby_payload(params["location"], params.get("keyword", ""), float(params["radius"]), config["results"]))
+        if endpoint == "details":
+            return self.send_json(details_payload(params["place_id"]))
+        if endpoint == "distance_matrix":
+            return self.send_json(matrix_payload(params["destinations"]))
+        self.send_response(200)
+        self.send_header("Content-Type", "image/png")
+        self.send_header("Content-Length", str(len(PHOTO_BYTES)))
+        self.end_headers()
+        self.wfile.write(PHOTO_BYTES)
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        if url.path == "/__stats/reset":
+            self.state.reset(); return self.send_json({"ok": True})
+        if url.path != "/v1/chat/completions":
+            return self.send_json({"error": "unknown endpoint"}, 404)
+        endpoint, content = chat_content(self.state, body["messages"])
+        outcome = self.state.begin(endpoint)
+        if outcome == "throttled":
+            return self.send_json({"error": {"message": "Rate limit reached", "type": "requests", "code": "rate_limit_exceeded"}}, 429)
+        if outcome == "error":
+            return self.send_json({"error": {"message": "stub failure", "type": "server_error"}}, 500)
+        base = {"id": "chatcmpl-stub", "created": int(time.time()), "model": body.get("model", "stub")}
+        if not body.get("stream"):
+            return self.send_json({**base, "object": "chat.completion", "usage": None, "choices": [
+                {"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": content}}]})
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        for i in range(0, len(content), 40):
+            chunk = {**base, "object": "chat.completion.chunk", "choices": [{"index": 0, "finish_reason": None, "delta": {"content": content[i:i + 40]}}]}
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode())
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.close_connection = True
+
+
+def load_profile(path):
+    profile = {name: dict(config) for name, config in DEFAULT_PROFILE.items()}
+    if path:
+        with open(path) as f:
+            for name, overrides in json.load(f).items():
+                profile.setdefault(name, {}).update(overrides)
+    return profile
+
+
+def serve(port, profile, seed=0):
+    Handler.state = StubState(profile, seed)
+    server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+    server.daemon_threads = True
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--port", type=int, default=8099)
+    parser.add_argument("--profile", help="JSON file overriding latency, error rates and result counts per endpoint")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    server = serve(args.port, load_profile(args.profile), args.seed)
+    print(f"Stub upstreams listening on http://127.0.0.1:{args.port}", flush=True)
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()